@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Local stand-in for VitaShell's FTP server, for benchmarks and offline
+# testing. Serves a temporary ux0: tree (video/, music/), answers the
+# commands VitaFTP uses (CWD, MKD, TYPE, PASV, REST, STOR, SIZE, AVBL, NOOP)
+# and can add latency to every reply and cap the upload bandwidth.
+#
+#   python benchmarks/ftp_standin.py --port 1337 --latency 20 --bandwidth 2M
+
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import socketserver
+
+BANNER = "220 FTPVita Server ready."  # VitaShell's banner, matched by --discover
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.cwd = []
+        self.rest = 0
+        self.data_listener = None
+
+    def reply(self, line):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write((line + "\r\n").encode('utf-8'))
+
+    def handle(self):
+        self.reply(BANNER)
+        for raw in self.rfile:
+            line = raw.decode('utf-8', 'replace').strip()
+            if not line:
+                continue
+            command, _, argument = line.partition(' ')
+            handler = getattr(self, f"cmd_{command.upper()}", None)
+            if handler is None:
+                self.reply(f"502 {command} not implemented")
+                continue
+            if handler(argument) is False:
+                break
+
+    def _resolve(self, path):
+        # Virtual path (list of parts, first one a device like "ux0:") -> local path
+        parts = [] if path.startswith('/') else list(self.cwd)
+        for part in path.replace('\\', '/').split('/'):
+            if part in ('', '.'):
+                continue
+            if part == '..':
+                if parts:
+                    parts.pop()
+            elif part.endswith(':'):
+                parts = [part]
+            else:
+                parts.append(part)
+        if not parts:
+            return parts, self.server.root
+        return parts, os.path.join(self.server.root, parts[0].rstrip(':'), *parts[1:])
+
+    def cmd_USER(self, argument):
+        self.reply("331 Password required")
+
+    def cmd_PASS(self, argument):
+        self.reply("230 Logged in")
+
+    def cmd_NOOP(self, argument):
+        self.reply("200 OK")
+
+    def cmd_TYPE(self, argument):
+        self.reply("200 Type set")
+
+    def cmd_PWD(self, argument):
+        self.reply(f'257 "/{"/".join(self.cwd)}" is the current directory')
+
+    def cmd_CWD(self, argument):
+        parts, local = self._resolve(argument)
+        if os.path.isdir(local):
+            self.cwd = parts
+            self.reply("250 Directory changed")
+        else:
+            self.reply("550 No such directory")
+
+    def cmd_MKD(self, argument):
+        _, local = self._resolve(argument)
+        try:
+            os.mkdir(local)
+            self.reply(f'257 "{argument}" created')
+        except OSError as e:
+            self.reply(f"550 {e.strerror}")
+
+    def cmd_SIZE(self, argument):
+        _, local = self._resolve(argument)
+        if os.path.isfile(local):
+            self.reply(f"213 {os.path.getsize(local)}")
+        else:
+            self.reply("550 No such file")
+
+    def cmd_AVBL(self, argument):
+        self.reply(f"213 {shutil.disk_usage(self.server.root).free}")
+
+    def cmd_REST(self, argument):
+        self.rest = int(argument)
+        self.reply(f"350 Restarting at {self.rest}")
+
+    def cmd_PASV(self, argument):
+        if self.data_listener:
+            self.data_listener.close()
+        self.data_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.data_listener.bind(('127.0.0.1', 0))
+        self.data_listener.listen(1)
+        port = self.data_listener.getsockname()[1]
+        self.reply(f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 0xff})")
+
+    def cmd_STOR(self, argument):
+        if not self.data_listener:
+            self.reply("425 Use PASV first")
+            return
+        _, local = self._resolve(argument)
+        rest, self.rest = self.rest, 0
+        self.reply("150 Opening data connection")
+        connection, _ = self.data_listener.accept()
+        self.data_listener.close()
+        self.data_listener = None
+
+        bandwidth = self.server.bandwidth
+        received = 0
+        start = time.monotonic()
+        with connection, open(local, 'r+b' if rest and os.path.exists(local) else 'wb') as f:
+            f.seek(rest)
+            f.truncate()
+            while True:
+                chunk = connection.recv(64 * 1024)
+                if not chunk:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+                if bandwidth:
+                    # Hold the connection back to the configured rate
+                    ahead = received / bandwidth - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        self.reply("226 Transfer complete")
+
+    def cmd_QUIT(self, argument):
+        self.reply("221 Goodbye")
+        return False
+
+class VitaStandin(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0, latency=0.0, bandwidth=None, root=None):
+        """latency in seconds per reply, bandwidth in bytes/s (None = unlimited)."""
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.owns_root = root is None
+        self.root = root or tempfile.mkdtemp(prefix='vita-standin-')
+        for folder in ('video', 'music'):
+            os.makedirs(os.path.join(self.root, 'ux0', folder), exist_ok=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.owns_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from modules.helpers import parse_size
+
+    parser = argparse.ArgumentParser(description='Local VitaShell FTP stand-in')
+    parser.add_argument('--port', type=int, default=1337)
+    parser.add_argument('--latency', type=float, default=0, help='Milliseconds added to every reply')
+    parser.add_argument('--bandwidth', help='Upload cap per connection, e.g. 2M (bytes/s)')
+    parser.add_argument('--root', help='Folder to serve as the memory card (default: a temporary folder)')
+    args = parser.parse_args()
+
+    server = VitaStandin(args.port, args.latency / 1000,
+                         parse_size(args.bandwidth) if args.bandwidth else None, args.root)
+    print(f"Serving ux0: from {server.root} on 127.0.0.1:{server.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Startup benchmark: wall time of short CLI commands in a fresh interpreter.
+#
+#   python benchmarks/startup.py                  # 10 runs per command
+#   python benchmarks/startup.py --runs 20 --importtime
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'psmedia.py')
+
+COMMANDS = {
+    'history': ['--history'],
+    'config': ['--config-show'],
+    'version': ['--version'],
+}
+
+TARGET_MS = 100
+
+def time_command(args, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, SCRIPT, *args], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, cwd=ROOT)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def show_import_times(args):
+    # -X importtime writes one line per imported module to stderr
+    result = subprocess.run([sys.executable, '-X', 'importtime', SCRIPT, *args],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, cwd=ROOT)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        rows.append((int(cumulative_us), name.strip()))
+    for cumulative_us, name in sorted(rows, reverse=True)[:15]:
+        print(f"    {cumulative_us / 1000:8.1f} ms  {name}")
+
+def main():
+    parser = argparse.ArgumentParser(description='PSVMP startup benchmark')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--importtime', action='store_true', help='Show the slowest imports per command')
+    args = parser.parse_args()
+    
+    # Interpreter startup alone, for reference
+    interpreter = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'])
+        interpreter.append((time.perf_counter() - start) * 1000)
+    print(f"{'python -c pass':<16} median {statistics.median(interpreter):7.1f} ms")
+    
+    failed = False
+    for name, command_args in COMMANDS.items():
+        timings = time_command(command_args, args.runs)
+        median = statistics.median(timings)
+        status = "OK" if median < TARGET_MS else f"SLOW (target {TARGET_MS} ms)"
+        failed = failed or median >= TARGET_MS
+        print(f"{name:<16} median {median:7.1f} ms  min {min(timings):7.1f} ms  {status}")
+        if args.importtime:
+            show_import_times(command_args)
+    
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# End-to-end benchmark suite. Runs offline: inputs are generated with ffmpeg
+# lavfi (testsrc2/sine) and uploads go to a local VitaShell stand-in.
+#
+#   python benchmarks/suite.py run                       # full suite
+#   python benchmarks/suite.py run --quick --only transfer
+#   python benchmarks/suite.py run --output benchmarks/results/baseline.json
+#   python benchmarks/suite.py compare benchmarks/results/baseline.json benchmarks/results/latest.json
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import fnmatch
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import contextlib
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ftp_standin import VitaStandin
+
+RESULTS_FOLDER = os.path.join(ROOT, 'benchmarks', 'results')
+MEDIA_FOLDER = os.path.join(tempfile.gettempdir(), 'psvmp-bench-media')
+
+# name -> (width, height, seconds)
+VIDEO_CASES = {
+    '360p-10s': (640, 360, 10),
+    '720p-10s': (1280, 720, 10),
+    '1080p-10s': (1920, 1080, 10),
+    '720p-60s': (1280, 720, 60),
+}
+# name -> seconds of FLAC sine
+MUSIC_CASES = {
+    'sine-30s': 30,
+    'sine-180s': 180,
+}
+# name -> (latency in seconds per reply, bandwidth in bytes/s)
+TRANSFER_PROFILES = {
+    'local': (0, None),
+    'wifi': (0.005, 3 * 1024 * 1024),
+}
+TRANSFER_SIZE = 16 * 1024 * 1024
+VERIFY_CASE = '720p-60s'
+QUICK = {'video': ['360p-10s'], 'music': ['sine-30s'], 'transfer_size': 4 * 1024 * 1024}
+
+def _ffmpeg(*args):
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', *args], check=True)
+
+def video_input(name):
+    width, height, seconds = VIDEO_CASES[name]
+    path = os.path.join(MEDIA_FOLDER, f"video-{name}.mp4")
+    if not os.path.exists(path):
+        _ffmpeg('-f', 'lavfi', '-i', f"testsrc2=size={width}x{height}:rate=30:duration={seconds}",
+                '-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=48000:duration={seconds}",
+                '-c:v', 'libx264', '-preset', 'ultrafast', '-profile:v', 'high', '-pix_fmt', 'yuv420p',
+                '-c:a', 'aac', '-shortest', path)
+    return path
+
+def music_input(name):
+    path = os.path.join(MEDIA_FOLDER, f"music-{name}.flac")
+    if not os.path.exists(path):
+        _ffmpeg('-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=44100:duration={MUSIC_CASES[name]}",
+                '-metadata', 'title=Benchmark', '-metadata', 'artist=PSVMP', '-c:a', 'flac', path)
+    return path
+
+def transfer_input(size):
+    # Random bytes: the transfer path doesn't care about the content
+    path = os.path.join(MEDIA_FOLDER, f"transfer-{size}.bin")
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        with open(path, 'wb') as f:
+            for _ in range(size // (1024 * 1024)):
+                f.write(os.urandom(1024 * 1024))
+    return path
+
+def build_benchmarks(quick):
+    from modules.conversion import convert_for_vita_video, convert_for_vita_music
+    from modules.helpers import verify_media_file
+    from modules.transfer import VitaFTP
+
+    benchmarks = []
+    output_folder = tempfile.mkdtemp(prefix='psvmp-bench-out-')
+    has_ffmpeg = shutil.which('ffmpeg') is not None
+
+    video_cases = QUICK['video'] if quick else list(VIDEO_CASES)
+    music_cases = QUICK['music'] if quick else list(MUSIC_CASES)
+    if has_ffmpeg:
+        for name in video_cases:
+            output = os.path.join(output_folder, f"{name}.mp4")
+            benchmarks.append((f"convert_video/{name}",
+                               lambda name=name, output=output: convert_for_vita_video(video_input(name), output)))
+        for name in music_cases:
+            output = os.path.join(output_folder, f"{name}.mp3")
+            benchmarks.append((f"convert_music/{name}",
+                               lambda name=name, output=output: convert_for_vita_music(music_input(name), output)))
+        verify_case = video_cases[-1] if quick else VERIFY_CASE
+        for tier in ('fast', 'standard', 'deep'):
+            benchmarks.append((f"verify/{tier}/{verify_case}",
+                               lambda tier=tier: verify_media_file(video_input(verify_case), 'video', tier)))
+    else:
+        print("ffmpeg not found: skipping conversion and verification benchmarks")
+
+    size = QUICK['transfer_size'] if quick else TRANSFER_SIZE
+    servers = []
+    for profile, (latency, bandwidth) in TRANSFER_PROFILES.items():
+        # Started once, outside the timed part
+        server = VitaStandin(0, latency, bandwidth).start()
+        servers.append(server)
+        benchmarks.append((f"transfer/{profile}/{size // (1024 * 1024)}MB",
+                           lambda port=server.port: VitaFTP('127.0.0.1', port).transfer(
+                               transfer_input(size), 'ux0:/video/shows/bench.bin')))
+
+    def cleanup():
+        for server in servers:
+            server.stop()
+        shutil.rmtree(output_folder, ignore_errors=True)
+
+    return benchmarks, cleanup
+
+def run(args):
+    os.makedirs(MEDIA_FOLDER, exist_ok=True)
+    benchmarks, cleanup = build_benchmarks(args.quick)
+    if args.only:
+        benchmarks = [(name, func) for name, func in benchmarks if fnmatch.fnmatch(name, f"*{args.only}*")]
+
+    results = {}
+    try:
+        for name, func in benchmarks:
+            timings = []
+            for _ in range(args.runs):
+                # The stages print progress; keep the report readable
+                with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                    start = time.perf_counter()
+                    func()
+                    timings.append(time.perf_counter() - start)
+            results[name] = {'median_s': statistics.median(timings), 'min_s': min(timings), 'runs': len(timings)}
+            print(f"{name:<32} median {results[name]['median_s']:8.3f} s  min {results[name]['min_s']:8.3f} s")
+    finally:
+        cleanup()
+
+    ffmpeg_version = None
+    if shutil.which('ffmpeg'):
+        ffmpeg_version = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout.split('\n')[0]
+    report = {
+        'created': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'ffmpeg': ffmpeg_version,
+        'quick': args.quick,
+        'results': results,
+    }
+    output = args.output or os.path.join(RESULTS_FOLDER, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+def compare(args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)['results']
+
+    regressions = 0
+    for name in sorted(set(baseline) | set(current)):
+        if name not in baseline or name not in current:
+            print(f"{name:<32} {'only in ' + ('current' if name in current else 'baseline'):>30}")
+            continue
+        before, after = baseline[name]['median_s'], current[name]['median_s']
+        change = (after - before) / before if before else 0.0
+        if change > args.threshold:
+            status = "REGRESSION"
+            regressions += 1
+        elif change < -args.threshold:
+            status = "faster"
+        else:
+            status = "ok"
+        print(f"{name:<32} {before:8.3f} s -> {after:8.3f} s  {change:+7.1%}  {status}")
+
+    print(f"\n{regressions} regression(s) above {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+def main():
+    parser = argparse.ArgumentParser(description='PSVMP benchmark suite')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks and save the results as JSON')
+    run_parser.add_argument('--runs', type=int, default=3)
+    run_parser.add_argument('--quick', action='store_true', help='Smallest inputs only')
+    run_parser.add_argument('--only', metavar='PATTERN', help='Run benchmarks whose name contains PATTERN')
+    run_parser.add_argument('--output', metavar='FILE', help='Results file (default: benchmarks/results/<timestamp>.json)')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.10,
+                                help='Relative slowdown reported as a regression (default: 0.10)')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    else:
+        compare(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import asyncio
+import itertools
+import threading
+
+from .scheduler import Scheduler, Job
+from .jobqueue import PRIORITIES
+from .config import load_config, resolve_vita_targets
+from .helpers import logger, parse_size
+
+# Job ids are unique per process (temp folders get a unique suffix as well)
+_job_ids = itertools.count(1)
+
+class JobFailed(Exception):
+    def __init__(self, job):
+        super().__init__(f"Job {job.id} {job.state}: {job.error or job.url}")
+        self.job = job
+
+class Pipeline:
+    """Download, convert and transfer jobs in this process, without the CLI.
+
+        with Pipeline() as pipeline:
+            job = pipeline.submit("https://youtu.be/ID")
+            job.wait()
+            print(job.state, job.converted_file, job.uploads)
+
+        async with Pipeline(targets=[("192.168.1.20", 1337)]) as pipeline:
+            jobs = await asyncio.gather(*(pipeline.run(url) for url in urls))
+
+    Jobs are scheduler Jobs: state, stage, progress, error, downloaded_file,
+    converted_file and uploads are kept up to date while they run.
+    """
+
+    def __init__(self, targets=None, download_workers=2, convert_workers=1, transfer_workers=2,
+                 discover=None, on_update=None, offline_action=None):
+        config = load_config(silent=True)
+        self.targets = targets or resolve_vita_targets(config['vita_ip'], config['vita_port'], config)
+        self.on_update = on_update  # on_update(job, fields) for every job
+        self.scheduler = Scheduler(download_workers, convert_workers, transfer_workers,
+                                   config['auto_discover'] if discover is None else discover,
+                                   offline_action=offline_action)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def submit(self, url, media_type='video', targets=None, target_size=None, two_pass=False,
+               on_update=None, priority='normal'):
+        # url is a media URL or a local file; target_size in bytes, a size like "700M",
+        # or 'card' for what is left on the (smallest) target's memory card.
+        # priority 'high' jumps ahead of queued 'normal' and 'low' jobs at every stage.
+        if self.closed:
+            raise RuntimeError("Pipeline is closed")
+        if media_type not in ('video', 'music'):
+            raise ValueError(f"Unknown media type: {media_type}")
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        if isinstance(target_size, str) and target_size != 'card':
+            target_size = parse_size(target_size)
+
+        def report(job, fields):
+            for callback in (on_update, self.on_update):
+                if callback:
+                    callback(job, fields)
+
+        job = Job(next(_job_ids), url, media_type, targets or self.targets, report,
+                  {'target_size': target_size, 'two_pass': two_pass}, priority)
+        with self.lock:
+            self.jobs[job.id] = job
+        job.add_done_callback(self._forget)
+        logger.info(f"Pipeline job {job.id} submitted: {url}")
+        self.scheduler.submit(job)
+        return job
+
+    def _forget(self, job):
+        with self.lock:
+            self.jobs.pop(job.id, None)
+
+    def cancel(self, job):
+        # job or job id; False if it already finished
+        job = self.jobs.get(getattr(job, 'id', job))
+        if job:
+            job.cancel()
+        return job is not None
+
+    def active_jobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    async def wait(self, job, check=False):
+        """Wait for a job without blocking the event loop. Cancelling the
+        awaiting task cancels the job. check=True raises JobFailed unless
+        the job completed."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(done_job):
+            if not future.done():
+                future.set_result(done_job)
+
+        job.add_done_callback(lambda done_job: loop.call_soon_threadsafe(resolve, done_job))
+        try:
+            await future
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        if check and job.state != 'completed':
+            raise JobFailed(job)
+        return job
+
+    async def run(self, url, media_type='video', check=False, **options):
+        # submit() and wait(); options are those of submit()
+        return await self.wait(self.submit(url, media_type, **options), check)
+
+    def close(self, wait=True, cancel=False):
+        self.closed = True
+        if cancel:
+            for job in self.active_jobs():
+                job.cancel()
+        self.scheduler.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # Cancel outstanding jobs when leaving on an error (or Ctrl+C)
+        self.close(cancel=exc_type is not None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await asyncio.get_running_loop().run_in_executor(None, lambda: self.close(cancel=exc_type is not None))
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+from .constants import PSVMP_DIR
+from .helpers import logger
+from .history import evictable_files
+from .events import emit
+
+CACHE_FILE = os.path.join(PSVMP_DIR, "conversion_cache.json")
+FINGERPRINT_CHUNK = 1024 * 1024
+
+_lock = threading.Lock()
+
+def file_fingerprint(file_path):
+    # Size plus the first and last MB: cheap to compute even for multi-GB
+    # files, and stable across renames and copies of the same content.
+    size = os.path.getsize(file_path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(file_path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_CHUNK))
+        if size > FINGERPRINT_CHUNK:
+            f.seek(max(FINGERPRINT_CHUNK, size - FINGERPRINT_CHUNK))
+            digest.update(f.read(FINGERPRINT_CHUNK))
+    return digest.hexdigest()
+
+def _load_index():
+    try:
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def _save_index(index):
+    os.makedirs(PSVMP_DIR, exist_ok=True)
+    tmp_path = CACHE_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, CACHE_FILE)
+
+def _cache_key(fingerprint, media_type, variant):
+    # variant separates conversions of the same source with different settings
+    return f"{media_type}:{fingerprint}" + (f":{variant}" if variant else "")
+
+def lookup_converted(fingerprint, media_type, variant=None):
+    key = _cache_key(fingerprint, media_type, variant)
+    with _lock:
+        index = _load_index()
+        entry = index.get(key)
+        if entry and os.path.exists(entry['output']):
+            # Last use decides the eviction order
+            entry['used'] = time.time()
+            try:
+                _save_index(index)
+            except OSError as e:
+                logger.warning(f"Failed to update conversion cache: {e}")
+        else:
+            entry = None
+    
+    emit('cache', cache='converted', hit=entry is not None)
+    if entry:
+        logger.info(f"Conversion cache hit: {os.path.basename(entry['output'])}")
+        return entry['output']
+    return None
+
+def store_converted(fingerprint, media_type, source, output, variant=None):
+    with _lock:
+        index = _load_index()
+        index[_cache_key(fingerprint, media_type, variant)] = {
+            'source': source,
+            'output': output,
+            'created': time.time()
+        }
+        try:
+            _save_index(index)
+        except OSError as e:
+            logger.warning(f"Failed to update conversion cache: {e}")
+
+def evict_converted(bytes_needed, protected=()):
+    # Deletes cached conversions, least recently used first, until
+    # bytes_needed are freed. Only files the history shows as delivered (and
+    # never held or failed) are candidates, so nothing still waiting for a
+    # Vita is lost. Returns the number of bytes freed.
+    delivered = evictable_files()
+    freed = 0
+    with _lock:
+        index = _load_index()
+        entries = sorted(index.items(), key=lambda item: item[1].get('used', item[1]['created']))
+        for key, entry in entries:
+            if freed >= bytes_needed:
+                break
+            output = entry['output']
+            if output in protected or os.path.basename(output) not in delivered:
+                continue
+            try:
+                size = os.path.getsize(output)
+                os.remove(output)
+            except OSError:
+                index.pop(key)
+                continue
+            index.pop(key)
+            freed += size
+            logger.info(f"Evicted cached conversion: {os.path.basename(output)} ({size} bytes)")
+        try:
+            _save_index(index)
+        except OSError as e:
+            logger.warning(f"Failed to update conversion cache: {e}")
+    return freed
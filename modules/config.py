@@ -7,7 +7,7 @@ from .constants import (
     DEFAULT_VITA_IP, DEFAULT_VITA_PORT, VITA_VIDEO_PATH, VITA_MUSIC_PATH,
     MAX_RETRIES, RETRY_DELAY, PSVMP_DIR
 )
-from .helpers import logger
+from .helpers import logger, VERIFY_TIERS, LOG_LEVELS, LOG_FORMATS, parse_size
 
 def get_config_path():
     return os.path.join(PSVMP_DIR, 'configuration.json')
@@ -32,7 +32,7 @@ def load_config(silent=False):
             
             if not silent:
                 logger.info(f"Configuration loaded from: {config_path}")
-            return loaded_config
+            return {**DEFAULT_CONFIG, **loaded_config}
         except Exception as e:
             if not silent:
                 logger.warning(f"Failed to load configuration: {e}. Using defaults.")
@@ -56,6 +56,7 @@ def save_config(config=None):
     config_path = get_config_path()
     
     try:
+        os.makedirs(PSVMP_DIR, exist_ok=True)
         with open(config_path, 'w', encoding='utf-8') as f:
             json.dump(config, f, indent=4, ensure_ascii=False)
         
@@ -65,15 +66,34 @@ def save_config(config=None):
         logger.error(f"Failed to save configuration: {e}")
         return None
 
+def resolve_vita_targets(ip_arg, default_port, config):
+    # "192.168.1.7,192.168.1.8:1338" or a device group name from the config
+    groups = config.get('device_groups', {})
+    targets = []
+    for entry in [e.strip() for e in str(ip_arg).split(',') if e.strip()]:
+        for member in groups.get(entry, [entry]):
+            ip, _, port = member.partition(':')
+            target = (ip, int(port) if port else default_port)
+            if target not in targets:
+                targets.append(target)
+    return targets
+
+def verify_tier(stage):
+    # Configured verification tier for 'download' or 'converted'
+    tier = load_config(silent=True).get(f'verify_{stage}', 'standard')
+    return tier if tier in VERIFY_TIERS else 'standard'
+
+def remember_vita_ip(ip):
+    # Cache the last discovered address so the next run connects directly
+    config = load_config(silent=True)
+    if config.get('vita_ip') == ip:
+        return
+    config['vita_ip'] = ip
+    if save_config(config):
+        logger.info(f"Remembered PS Vita address: {ip}")
+
 def show_config():
-    config = {
-        'vita_ip': DEFAULT_VITA_IP,
-        'vita_port': DEFAULT_VITA_PORT,
-        'video_path': VITA_VIDEO_PATH,
-        'music_path': VITA_MUSIC_PATH,
-        'max_retries': MAX_RETRIES,
-        'retry_delay': RETRY_DELAY
-    }
+    config = load_config(silent=True)
     
     print("\nCurrent Configuration:")
     print("-" * 40)
@@ -115,13 +135,52 @@ def handle_config_command(args):
                 key, value = setting.split('=', 1)
                 key = key.strip()
                 
+                # group.NAME=ip1,ip2:port defines a device group, an empty value removes it
+                if key.startswith('group.'):
+                    group_name = key.split('.', 1)[1]
+                    members = [m.strip() for m in value.split(',') if m.strip()]
+                    groups = dict(config.get('device_groups', {}))
+                    if members:
+                        groups[group_name] = members
+                        print(f"Updated device group {group_name}: {', '.join(members)}")
+                    else:
+                        groups.pop(group_name, None)
+                        print(f"Removed device group {group_name}")
+                    config['device_groups'] = groups
+                    logger.info(f"Config updated: device group {group_name} = {members}")
+                    continue
+                
                 # Convert value to appropriate type
-                if key in ['vita_port', 'max_retries']:
+                if key in ['vita_port', 'max_retries', 'concurrent_fragments', 'playlist_workers', 'stage_retries']:
                     value = int(value)
                 elif key in ['retry_delay']:
                     value = float(value)
-                elif key in ['vita_ip', 'video_path', 'music_path']:
+                elif key in ['vita_ip', 'video_path', 'music_path', 'offline_action', 'video_encoder']:
                     value = str(value)
+                elif key in ['verify_download', 'verify_converted']:
+                    value = value.strip().lower()
+                    if value not in VERIFY_TIERS:
+                        print(f"Error: {key} must be one of {', '.join(VERIFY_TIERS)}")
+                        return False
+                elif key in ['temp_cap', 'converted_cap', 'min_free_space', 'download_limit',
+                             'job_download_limit', 'upload_limit', 'job_upload_limit']:
+                    value = value.strip()
+                    if value.lower() in ('', 'none'):
+                        value = None
+                    else:
+                        parse_size(value)  # rejects bad sizes with ValueError
+                elif key in ['log_level', 'log_format']:
+                    value = value.strip().lower()
+                    choices = LOG_LEVELS if key == 'log_level' else LOG_FORMATS
+                    if value not in choices:
+                        print(f"Error: {key} must be one of {', '.join(choices)}")
+                        return False
+                elif key in ['download_timeout', 'convert_timeout', 'stall_timeout']:
+                    # seconds; 0 or none turns the check off
+                    value = value.strip().lower()
+                    value = None if value in ('', '0', 'none') else int(value)
+                elif key in ['auto_discover', 'offline', 'verify_upload', 'pause_encodes']:
+                    value = value.strip().lower() in ('1', 'true', 'yes', 'on')
                 
                 if key in config:
                     old_value = config[key]
@@ -7,7 +7,31 @@ DEFAULT_CONFIG = {
     "video_path": "ux0:/video/shows/",
     "music_path": "ux0:/music/",
     "max_retries": 5,
-    "retry_delay": 3
+    "retry_delay": 3,
+    "offline_action": "hold",  # "hold" keeps the converted file, "fail" aborts before converting
+    "auto_discover": True,  # scan the local subnet when the Vita is not at vita_ip
+    "device_groups": {},  # name -> ["ip", "ip:port", ...], usable with --ip NAME
+    "offline": False,  # never contact PyPI for update checks
+    "video_encoder": "libx264",  # or "auto" for the fastest available (h264_nvenc, h264_qsv, ...)
+    "concurrent_fragments": 4,  # fragments yt-dlp fetches in parallel for one item
+    "playlist_workers": 3,  # playlist items downloaded at the same time
+    "verify_download": "standard",  # fast (headers), standard (ffprobe) or deep (full decode)
+    "verify_converted": "standard",  # checked on the converted file before upload
+    "verify_upload": True,  # compare the remote SIZE after each upload, resume if short
+    "temp_cap": None,  # e.g. "20G": most the temp folder may hold, None for no cap
+    "converted_cap": None,  # e.g. "50G": cached conversions above this are evicted
+    "min_free_space": "1G",  # always leave this much free on the disk
+    "download_limit": None,  # e.g. "5M": bytes/s for all downloads together, None for unlimited
+    "job_download_limit": None,  # cap for a single download
+    "upload_limit": None,  # bytes/s for all uploads to the Vitas together
+    "job_upload_limit": None,  # cap for a single upload
+    "download_timeout": 4 * 3600,  # seconds a download stage may take, None for no deadline
+    "convert_timeout": 6 * 3600,  # seconds a convert stage may take (both passes)
+    "stall_timeout": 300,  # kill yt-dlp/megatools/ffmpeg after this many seconds without progress
+    "stage_retries": 1,  # times a timed-out stage is requeued before the job fails
+    "pause_encodes": True,  # pause lower-priority encodes while a high-priority one runs (not on Windows)
+    "log_level": "info",  # "debug" also logs every line of ffmpeg output
+    "log_format": "text"  # or "json": one JSON object per line, with the job id
 }
 
 USER_DOCS = os.path.join(os.path.expanduser("~"), "Documents")
@@ -30,9 +54,4 @@ DEFAULT_VITA_PORT = DEFAULT_CONFIG["vita_port"]
 VITA_VIDEO_PATH = DEFAULT_CONFIG["video_path"]
 VITA_MUSIC_PATH = DEFAULT_CONFIG["music_path"]
 MAX_RETRIES = DEFAULT_CONFIG["max_retries"]
-RETRY_DELAY = DEFAULT_CONFIG["retry_delay"]
-
-os.makedirs(TEMP_FOLDER, exist_ok=True)
-os.makedirs(CONVERTED_FOLDER, exist_ok=True)
-os.makedirs(LOG_FOLDER, exist_ok=True)
-os.makedirs(PSVMP_DIR, exist_ok=True)
\ No newline at end of file
+RETRY_DELAY = DEFAULT_CONFIG["retry_delay"]
\ No newline at end of file
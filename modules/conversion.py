@@ -1,27 +1,42 @@
 import os
 import subprocess
-import json
 import re
-from .helpers import logger, verify_media_file
+import logging
+from collections import deque
+from .helpers import logger, verify_media_file, probe_media
+from .config import verify_tier
 from .constants import CONVERTED_FOLDER 
+from .process import run_watched, StageTimeout, ProcessCancelled
+from .events import span
 
-def run_ffmpeg_conversion(cmd, input_file, output_file, media_type):
+def run_ffmpeg_conversion(cmd, input_file, output_file, media_type, final=True, quiet=False):
+    # final=False is used for the analysis pass of a two-pass encode, which
+    # writes no output file to verify. quiet=True keeps parallel batch
+    # encodes from interleaving their progress lines on the console.
     try:
         logger.info(f"Running FFmpeg conversion: {os.path.basename(input_file)} -> {os.path.basename(output_file)}")
-        print("Running FFmpeg conversion...")
-        print("Please wait, this may take a few minutes...")
-        
-        process = subprocess.Popen(
-            cmd, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.STDOUT, 
-            universal_newlines=True,
-            encoding='utf-8',
-            errors='replace'
-        )
+        if not quiet:
+            print("Running FFmpeg conversion...")
+            print("Please wait, this may take a few minutes...")
         
         last_time = ""
-        for line in process.stdout:
+        encoded = 0.0  # seconds of media done, from ffmpeg's time= stats
+        # Per-line output is only logged at debug level; the tail goes to
+        # the log if ffmpeg fails
+        tail = deque(maxlen=10)
+        log_lines = logger.isEnabledFor(logging.DEBUG)
+        def show(line):
+            nonlocal last_time, encoded
+            if log_lines:
+                logger.debug(f"ffmpeg: {line.rstrip()}")
+            time_match = re.search(r'time=(\d+):(\d+):([\d.]+)', line)
+            if time_match:
+                hours, minutes, seconds = time_match.groups()
+                encoded = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+            else:
+                tail.append(line.strip())
+            if quiet:
+                return
             if 'time=' in line:
                 try:
                     # Extract just the time part
@@ -34,18 +49,26 @@ def run_ffmpeg_conversion(cmd, input_file, output_file, media_type):
                 except:
                     print("Converting...", flush=True)
             elif 'error' in line.lower() or 'failed' in line.lower():
-                logger.warning(f"FFmpeg warning: {line.strip()}")
                 print(f"Warning: {line.strip()}", flush=True)
         
-        process.wait()
+        with span('encode' if final else 'encode (analysis pass)', 'convert',
+                  file=os.path.basename(input_file)) as span_args:
+            returncode = run_watched(cmd, 'convert', on_line=show,
+                                     watch_path=output_file if final else None)
+            span_args['media_seconds'] = encoded
+        if returncode != 0:
+            logger.error("FFmpeg output:\n" + "\n".join(tail))
+            raise subprocess.CalledProcessError(returncode, cmd)
         
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, cmd)
+        if not final:
+            return output_file
         
-        if not verify_media_file(output_file, media_type):
+        if not verify_media_file(output_file, media_type, verify_tier('converted')):
             raise Exception("Conversion failed - output file is invalid")
         
         logger.info(f"Conversion completed: {os.path.basename(output_file)}")
+        if quiet:
+            return output_file
         print("=" * 50, flush=True)
         print("CONVERSION COMPLETED SUCCESSFULLY!", flush=True)
         print(f"Output file: {os.path.basename(output_file)}", flush=True)
@@ -54,37 +77,133 @@ def run_ffmpeg_conversion(cmd, input_file, output_file, media_type):
         
         return output_file
         
+    except (StageTimeout, ProcessCancelled) as e:
+        logger.error(f"Conversion stopped: {e}")
+        if final and os.path.exists(output_file):
+            os.remove(output_file)  # partial output
+        raise
     except subprocess.CalledProcessError as e:
         logger.error(f"Conversion failed with error code {e.returncode}")
         raise Exception(f"Conversion failed with error code {e.returncode}")
 
-def convert_for_vita_video(input_file, output_file):
-    logger.info(f"Converting video for PS Vita: {os.path.basename(input_file)}")
-    print("Converting video for PS Vita...")
+def video_encoder_args(encoder):
+    # Baseline is the profile every Vita firmware plays; all of these can produce it
+    args = ['-c:v', encoder, '-profile:v', 'baseline']
+    if encoder in ('libx264', 'h264_nvenc'):
+        args += ['-level:v', '3.1']
+    return args
+
+# What the Vita plays without re-encoding
+VITA_MAX_WIDTH = 960
+VITA_MAX_HEIGHT = 544
+VITA_H264_PROFILES = ('Baseline', 'Constrained Baseline', 'Main')
+# profile_idc (the PP in an 'avc1.PPCCLL' codec string) as ffprobe names it
+AVC1_PROFILES = {'42': 'Baseline', '4d': 'Main', '58': 'Extended', '64': 'High',
+                 '6e': 'High 10', '7a': 'High 4:2:2', 'f4': 'High 4:4:4 Predictive'}
+
+def h264_profile_from_codec(codec):
+    # Profile name for a yt-dlp style vcodec string, or None if it doesn't say
+    codec = (codec or '').lower()
+    if not codec.startswith('avc1.'):
+        return None
+    return AVC1_PROFILES.get(codec[5:7])
+
+def is_vita_compatible_video(stream):
+    return (stream.get('codec_name') == 'h264' and
+            stream.get('profile') in VITA_H264_PROFILES and
+            stream.get('pix_fmt') == 'yuv420p' and
+            0 < int(stream.get('width', 0)) <= VITA_MAX_WIDTH and
+            0 < int(stream.get('height', 0)) <= VITA_MAX_HEIGHT)
+
+def is_vita_compatible_audio(stream):
+    return stream.get('codec_name') == 'aac' and int(stream.get('channels', 2)) <= 2
+
+# Size targeting: the video gets whatever the audio and container leave
+VITA_AUDIO_KBPS = 128
+VITA_MAX_VIDEO_KBPS = 2000
+MIN_VIDEO_KBPS = 200
+CONTAINER_OVERHEAD = 0.02
+
+def video_bitrate_for_size(target_bytes, duration):
+    total_kbps = target_bytes * 8 * (1 - CONTAINER_OVERHEAD) / 1000 / duration
+    video_kbps = int(total_kbps - VITA_AUDIO_KBPS)
+    if video_kbps < MIN_VIDEO_KBPS:
+        raise Exception(f"Target size too small: {target_bytes / (1024*1024):.1f} MB leaves only "
+                        f"{max(video_kbps, 0)}k for {duration / 60:.0f} minutes of video")
+    return min(video_kbps, VITA_MAX_VIDEO_KBPS)
+
+def convert_for_vita_video(input_file, output_file, encoder='libx264', target_size=None, two_pass=False):
+    logger.info(f"Converting video for PS Vita: {os.path.basename(input_file)} (encoder: {encoder})")
+    print(f"Converting video for PS Vita (encoder: {encoder})...")
     
-    if not verify_media_file(input_file, 'video'):
+    # One probe serves the integrity check, the size target and the stream choice
+    probe = probe_media(input_file)
+    if probe is None or not verify_media_file(input_file, 'video', probe=probe):
         raise Exception("Input video file is corrupted and cannot be converted")
     
-    cmd = [
-        'ffmpeg',
-        '-i', input_file,
-        '-c:v', 'libx264',
-        '-profile:v', 'baseline',
-        '-level:v', '3.1',
-        '-vf', 'scale=960:544:force_original_aspect_ratio=decrease,pad=960:544:-1:-1:black',
-        '-pix_fmt', 'yuv420p',
-        '-b:v', '1500k',
-        '-maxrate', '2000k',
-        '-bufsize', '4000k',
-        '-c:a', 'aac',
-        '-b:a', '128k',
-        '-ar', '44100',
-        '-movflags', '+faststart',
-        '-y',
-        output_file
-    ]
+    # Streams the Vita already plays are copied instead of re-encoded
+    streams = probe.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), {})
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+    duration = float(probe.get('format', {}).get('duration') or 0)
     
-    return run_ffmpeg_conversion(cmd, input_file, output_file, 'video')
+    video_kbps, max_kbps, buffer_kbps = 1500, 2000, 4000
+    if target_size and duration:
+        video_kbps = video_bitrate_for_size(target_size, duration)
+        max_kbps, buffer_kbps = max(video_kbps, min(int(video_kbps * 1.33), VITA_MAX_VIDEO_KBPS)), video_kbps * 2
+        logger.info(f"Target size {target_size / (1024*1024):.1f} MB over {duration:.0f}s -> video {video_kbps}k")
+        print(f"Target size {target_size / (1024*1024):.1f} MB -> video bitrate {video_kbps}k")
+    
+    source_kbps = int(probe.get('format', {}).get('bit_rate') or 0) / 1000
+    copy_video = is_vita_compatible_video(video) and not (target_size and source_kbps > video_kbps + VITA_AUDIO_KBPS)
+    copy_audio = is_vita_compatible_audio(audio)
+    # Two-pass only helps when libx264 actually encodes the video
+    two_pass = two_pass and not copy_video and encoder == 'libx264'
+    
+    if copy_video:
+        video_args = ['-c:v', 'copy']
+    else:
+        video_args = [
+            *video_encoder_args(encoder),
+            '-vf', 'scale=960:544:force_original_aspect_ratio=decrease,pad=960:544:-1:-1:black',
+            '-pix_fmt', 'yuv420p',
+            '-b:v', f'{video_kbps}k',
+            '-maxrate', f'{max_kbps}k',
+            '-bufsize', f'{buffer_kbps}k',
+        ]
+    
+    if copy_audio:
+        audio_args = ['-c:a', 'copy']
+    else:
+        audio_args = ['-c:a', 'aac', '-b:a', f'{VITA_AUDIO_KBPS}k', '-ar', '44100']
+    
+    mode = "remux" if copy_video and copy_audio else "partial copy" if copy_video or copy_audio else "full transcode"
+    if two_pass:
+        mode += ", two-pass"
+    logger.info(f"Conversion mode: {mode} (video {video.get('codec_name')} {video.get('width')}x{video.get('height')}, "
+                f"audio {audio.get('codec_name')})")
+    print(f"Conversion mode: {mode}")
+    
+    input_args = ['ffmpeg', '-i', input_file, '-map', '0:v:0', '-map', '0:a:0?']
+    
+    if not two_pass:
+        cmd = [*input_args, *video_args, *audio_args, '-movflags', '+faststart', '-y', output_file]
+        return run_ffmpeg_conversion(cmd, input_file, output_file, 'video')
+    
+    passlog = os.path.splitext(output_file)[0] + '_2pass'
+    try:
+        print("Pass 1 of 2 (analysis)...")
+        first_pass = [*input_args, *video_args, '-pass', '1', '-passlogfile', passlog, '-an', '-f', 'null', '-y', os.devnull]
+        run_ffmpeg_conversion(first_pass, input_file, os.devnull, 'video', final=False)
+        
+        print("Pass 2 of 2 (encode)...")
+        second_pass = [*input_args, *video_args, '-pass', '2', '-passlogfile', passlog, *audio_args,
+                       '-movflags', '+faststart', '-y', output_file]
+        return run_ffmpeg_conversion(second_pass, input_file, output_file, 'video')
+    finally:
+        for suffix in ('-0.log', '-0.log.mbtree'):
+            if os.path.exists(passlog + suffix):
+                os.remove(passlog + suffix)
 
 def embed_metadata_with_ffmpeg(input_file, metadata):
     if not metadata:
@@ -138,15 +257,16 @@ def embed_metadata_with_ffmpeg(input_file, metadata):
     
     return input_file
 
-def convert_for_vita_music(input_file, output_file):
+def convert_for_vita_music(input_file, output_file, quiet=False):
     logger.info(f"Converting audio to MP3 for PS Vita: {os.path.basename(input_file)}")
-    print("Converting audio to MP3 for PS Vita...")
+    if not quiet:
+        print("Converting audio to MP3 for PS Vita...")
     
-    if not verify_media_file(input_file, 'audio'):
+    # One ffprobe run serves as the integrity check and the tag source
+    probe = probe_media(input_file)
+    if probe is None:
         raise Exception("Input audio file is corrupted and cannot be converted")
-    
-    # First, extract existing metadata from the file
-    existing_metadata = extract_metadata_from_file(input_file)
+    existing_metadata = extract_metadata_from_file(input_file, probe)
     
     cmd = [
         'ffmpeg',
@@ -173,21 +293,13 @@ def convert_for_vita_music(input_file, output_file):
         if existing_metadata.get('genre'):
             cmd.extend(['-metadata', f'genre={existing_metadata["genre"]}'])
     
-    return run_ffmpeg_conversion(cmd, input_file, output_file, 'audio')
+    return run_ffmpeg_conversion(cmd, input_file, output_file, 'audio', quiet=quiet)
 
-def extract_metadata_from_file(file_path):
+def extract_metadata_from_file(file_path, probe=None):
+    # probe: ffprobe data the caller already has, to avoid a second run
     try:
-        cmd = [
-            'ffprobe',
-            '-v', 'quiet',
-            '-print_format', 'json',
-            '-show_format',
-            file_path
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
-            data = json.loads(result.stdout)
+        data = probe or probe_media(file_path)
+        if data:
             format_info = data.get('format', {})
             tags = format_info.get('tags', {})
             
@@ -0,0 +1,46 @@
+import socket
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+from .helpers import logger
+from .constants import DEFAULT_VITA_PORT
+
+def get_local_subnet():
+    # Connecting a UDP socket sends nothing, it only picks the outgoing interface
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(('10.255.255.255', 1))
+        local_ip = sock.getsockname()[0]
+    except OSError:
+        local_ip = '127.0.0.1'
+    finally:
+        sock.close()
+    
+    return ipaddress.ip_network(f"{local_ip}/24", strict=False)
+
+def probe_vitashell(ip, port=DEFAULT_VITA_PORT, timeout=0.5):
+    try:
+        with socket.create_connection((str(ip), port), timeout=timeout) as sock:
+            sock.settimeout(timeout)
+            banner = sock.recv(256).decode('utf-8', errors='replace').strip()
+    except OSError:
+        return None
+    
+    # VitaShell/FTPVita greet with "220 ... Vita..."
+    if banner.startswith('220') and 'vita' in banner.lower():
+        return banner
+    return None
+
+def discover_vitas(port=DEFAULT_VITA_PORT, subnet=None, timeout=0.5, workers=128):
+    network = ipaddress.ip_network(subnet, strict=False) if subnet else get_local_subnet()
+    hosts = [str(ip) for ip in network.hosts()]
+    logger.info(f"Scanning {network} for VitaShell FTP on port {port} ({len(hosts)} hosts)")
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        banners = executor.map(lambda ip: probe_vitashell(ip, port, timeout), hosts)
+        found = [(ip, banner) for ip, banner in zip(hosts, banners) if banner]
+    
+    for ip, banner in found:
+        logger.info(f"Found VitaShell FTP at {ip}:{port} ({banner})")
+    if not found:
+        logger.info(f"No VitaShell FTP server found on {network}")
+    return found
@@ -2,28 +2,27 @@ import os
 import subprocess
 import time
 import json
-import shutil
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
 from .helpers import (
     logger, create_folders, cleanup_temp_files,
     sanitize_filename, verify_media_file, detect_url_type
 )
-from .conversion import embed_metadata_with_ffmpeg
-from .constants import TEMP_FOLDER
+from .conversion import embed_metadata_with_ffmpeg, h264_profile_from_codec, VITA_H264_PROFILES
+from .toolchain import tool_path
+from .ratelimit import get_pool
+from .process import run_watched, StageTimeout, ProcessCancelled
+from .events import span, emit
+from .constants import TEMP_FOLDER, PSVMP_DIR
+from .config import load_config, verify_tier
 
 def get_metadata_from_url(url):
     try:
-        cmd = [
-            'yt-dlp',
-            '--dump-json',
-            '--no-warnings',
-            '--no-playlist',
-            url
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30, encoding='utf-8', errors='replace')
-        if result.returncode == 0:
-            metadata = json.loads(result.stdout)
-            
+        # Same --dump-json output as get_video_info(), so share its cache
+        metadata = get_video_info(url)
+        if metadata:
             title = sanitize_filename(metadata.get('title', 'Unknown Title'))
             artist = sanitize_filename(metadata.get('uploader', metadata.get('channel', 'Unknown Artist')))
             album = sanitize_filename(metadata.get('album', metadata.get('playlist_title', 'Unknown Album')))
@@ -44,57 +43,320 @@ def get_metadata_from_url(url):
     
     return None
 
-def download_from_mega(url):
+# Cost model for picking a source format. Estimated seconds of work:
+# download time at an assumed link speed, plus encode time relative to
+# the clip duration (zero for a remux).
+ASSUMED_DOWNLOAD_RATE = 2.5 * 1024 * 1024  # bytes/s
+VITA_TARGET_KBPS = 1500 + 128
+VITA_PIXELS = 960 * 544
+
+# Admission control and format selection both need the extractor metadata;
+# successful lookups are kept so each URL is only fetched once.
+_video_info = OrderedDict()
+_video_info_lock = threading.Lock()
+VIDEO_INFO_CACHE_SIZE = 64
+
+def get_video_info(url):
+    with _video_info_lock:
+        info = _video_info.get(url)
+    emit('cache', cache='video_info', hit=info is not None)
+    if info is not None:
+        return info
+    try:
+        cmd = [tool_path('yt-dlp') or 'yt-dlp', '--dump-json', '--no-warnings', '--no-playlist', url]
+        with span('probe', 'probe', url=url):
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=30, encoding='utf-8', errors='replace')
+        if result.returncode == 0:
+            info = json.loads(result.stdout)
+            with _video_info_lock:
+                _video_info[url] = info
+                while len(_video_info) > VIDEO_INFO_CACHE_SIZE:
+                    _video_info.popitem(last=False)
+            return info
+    except Exception as e:
+        logger.warning(f"Could not read format list: {e}")
+    return None
+
+def _format_bytes(fmt, duration):
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return size
+    if fmt.get('tbr') and duration:
+        return fmt['tbr'] * 1000 / 8 * duration
+    return None
+
+def _is_vita_h264(fmt):
+    # Only these profiles are copied by convert_for_vita_video(); High (avc1.64...)
+    # and a codec string without a profile are costed as a full transcode
+    return h264_profile_from_codec(fmt.get('vcodec')) in VITA_H264_PROFILES
+
+def _is_aac(fmt):
+    return (fmt.get('acodec') or '').startswith(('mp4a', 'aac'))
+
+def _encode_seconds(video_fmt, audio_fmt, duration):
+    height = video_fmt.get('height') or 0
+    width = video_fmt.get('width') or height * 16 // 9
+    if _is_vita_h264(video_fmt) and 0 < height <= 544 and width <= 960:
+        # Video is copied; at most the audio gets re-encoded
+        return 0 if _is_aac(audio_fmt) else duration * 0.02
+    # Full transcode: decode cost grows with source resolution
+    pixels = width * height or VITA_PIXELS
+    return duration * (0.3 + 0.2 * pixels / VITA_PIXELS)
+
+def _format_cost(video_fmt, audio_fmt, duration):
+    sizes = [_format_bytes(video_fmt, duration)]
+    if audio_fmt is not video_fmt:
+        sizes.append(_format_bytes(audio_fmt, duration))
+    if None in sizes:
+        return None
+    download_seconds = sum(sizes) / ASSUMED_DOWNLOAD_RATE
+    
+    # Anything far below the Vita's target bitrate will look worse than the
+    # encode we would otherwise do, so penalise it
+    kbps = sum(sizes) * 8 / 1000 / duration
+    quality_penalty = duration * 0.5 if kbps < VITA_TARGET_KBPS * 0.4 else 0
+    return download_seconds + _encode_seconds(video_fmt, audio_fmt, duration) + quality_penalty
+
+def select_vita_format(info):
+    # Returns (format_spec, estimated_cost_seconds, description) or None
+    duration = info.get('duration') or 0
+    formats = info.get('formats') or []
+    if not duration or not formats:
+        return None
+    
+    has_video = lambda f: f.get('vcodec') not in (None, 'none')
+    has_audio = lambda f: f.get('acodec') not in (None, 'none')
+    # Nothing bigger than 720p is ever worth downloading for a 544p screen
+    video_only = [f for f in formats if has_video(f) and not has_audio(f) and (f.get('height') or 0) <= 720]
+    audio_only = [f for f in formats if has_audio(f) and not has_video(f)]
+    muxed = [f for f in formats if has_video(f) and has_audio(f) and (f.get('height') or 0) <= 720]
+    
+    candidates = [(f['format_id'], f, f) for f in muxed]
+    candidates += [(f"{v['format_id']}+{a['format_id']}", v, a) for v in video_only for a in audio_only]
+    
+    best = None
+    for spec, video_fmt, audio_fmt in candidates:
+        cost = _format_cost(video_fmt, audio_fmt, duration)
+        if cost is not None and (best is None or cost < best[1]):
+            description = (f"{video_fmt.get('width')}x{video_fmt.get('height')} {video_fmt.get('vcodec')}"
+                           f" / {audio_fmt.get('acodec')}")
+            best = (spec, cost, description)
+    return best
+
+# Playlists, channels, SoundCloud sets and Mega folders are expanded with one flat
+# extraction (no per-item page fetches); the result is cached so
+# re-running the same playlist does not hit the site again.
+PLAYLIST_CACHE_FOLDER = os.path.join(PSVMP_DIR, "playlists")
+PLAYLIST_CACHE_TTL = 6 * 3600  # seconds
+SOUNDCLOUD_USER_TABS = ('tracks', 'albums', 'popular-tracks', 'reposts', 'likes')
+
+def is_playlist_url(url):
+    parsed = urlparse(url)
+    path = parsed.path.strip('/').split('/') if parsed.path.strip('/') else []
+    url_type = detect_url_type(url)
+    
+    if url_type == 'mega':
+        return is_mega_folder_url(url)
+    elif url_type == 'youtube':
+        # watch?v=...&list=... stays a single video, as before
+        if path and path[0] == 'playlist':
+            return True
+        return bool(path) and (path[0].startswith('@') or path[0] in ('channel', 'c', 'user'))
+    elif url_type == 'soundcloud':
+        if 'sets' in path:
+            return True
+        return len(path) == 1 or (len(path) == 2 and path[1] in SOUNDCLOUD_USER_TABS)
+    return False
+
+def _flat_extract(url):
+    cmd = [tool_path('yt-dlp') or 'yt-dlp', '--flat-playlist', '-J', '--no-warnings', url]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=300, encoding='utf-8', errors='replace')
+    if result.returncode != 0:
+        raise Exception(f"Could not list playlist: {result.stdout.strip() or result.returncode}")
+    return json.loads(result.stdout)
+
+def _flat_entries(data, depth=0):
+    entries = []
+    for entry in data.get('entries') or []:
+        if not entry:
+            continue
+        item_url = entry.get('url') or entry.get('webpage_url')
+        if entry.get('ie_key') == 'YoutubeTab' and depth == 0:
+            # A channel lists its tabs (Videos, Shorts, ...) as nested playlists
+            entries.extend(_flat_entries(_flat_extract(item_url), depth + 1))
+        elif item_url:
+            entries.append({'url': item_url, 'title': entry.get('title') or item_url,
+                            'duration': entry.get('duration')})
+    return entries
+
+def expand_playlist(url, refresh=False):
+    """Return (title, [{'url', 'title', 'duration'}, ...]) for a playlist URL."""
+    cache_file = os.path.join(PLAYLIST_CACHE_FOLDER, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+    if not refresh and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if time.time() - cached['fetched'] < PLAYLIST_CACHE_TTL:
+                logger.info(f"Using cached playlist listing for {url}")
+                return cached['title'], cached['entries']
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable playlist cache {cache_file}: {e}")
+    
+    logger.info(f"Listing playlist: {url}")
+    if is_mega_folder_url(url):
+        title, entries = list_mega_folder(url)
+    else:
+        data = _flat_extract(url)
+        title = data.get('title') or url
+        entries = _flat_entries(data)
+    
+    try:
+        os.makedirs(PLAYLIST_CACHE_FOLDER, exist_ok=True)
+        with open(cache_file, 'w', encoding='utf-8') as f:
+            json.dump({'fetched': time.time(), 'url': url, 'title': title, 'entries': entries}, f, indent=2)
+    except OSError as e:
+        logger.warning(f"Could not cache playlist listing: {e}")
+    
+    logger.info(f"Playlist '{title}' has {len(entries)} item(s)")
+    return title, entries
+
+# Mega folder links are listed through the public folder API. Node handles
+# and sizes are plain; names are encrypted with the folder key, so items
+# are shown by handle until megatools has downloaded them.
+MEGA_API_URL = "https://g.api.mega.co.nz/cs"
+
+def parse_mega_folder_url(url):
+    """Return (folder_id, key) for a Mega folder link, or None."""
+    parsed = urlparse(url)
+    if detect_url_type(url) != 'mega':
+        return None
+    path = parsed.path.strip('/').split('/')
+    if path[0] == 'folder' and len(path) > 1 and parsed.fragment:
+        # Links into a subfolder or a single file keep their own behaviour
+        if '/' in parsed.fragment:
+            return None
+        return path[1], parsed.fragment
+    if parsed.fragment.startswith('F!'):
+        parts = parsed.fragment.split('!')
+        if len(parts) == 3:
+            return parts[1], parts[2]
+    return None
+
+def is_mega_folder_url(url):
+    return parse_mega_folder_url(url) is not None
+
+def list_mega_folder(url):
+    import requests
+    
+    folder_id, key = parse_mega_folder_url(url)
+    response = requests.post(MEGA_API_URL, params={'id': int(time.time()), 'n': folder_id},
+                             json=[{'a': 'f', 'c': 1, 'ca': 1, 'r': 1}], timeout=30)
+    response.raise_for_status()
+    result = response.json()
+    if isinstance(result, int) or isinstance(result[0], int):
+        raise Exception(f"Mega API error {result if isinstance(result, int) else result[0]}")
+    
+    entries = []
+    for node in result[0].get('f', []):
+        if node.get('t') != 0:  # folders and special nodes
+            continue
+        size = node.get('s') or 0
+        entries.append({
+            'url': f"https://mega.nz/folder/{folder_id}#{key}/file/{node['h']}",
+            'title': f"{node['h']} ({size / (1024*1024):.1f} MB)",
+            'duration': None,
+        })
+    return f"Mega folder {folder_id}", entries
+
+def download_mega_folder(url, temp_folder, on_file):
+    """Download a whole Mega folder with one megatools run, calling
+    on_file(path) for each file as soon as megatools has finished it."""
+    os.makedirs(temp_folder, exist_ok=True)
+    megatool_cmd = tool_path('megatools') or 'megatools'
+    
+    # megatools writes each file under a .megatmp name and renames it when done
+    seen = set()
+    def collect():
+        for root, _, files in os.walk(temp_folder):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if path not in seen and not name.startswith('.megatmp'):
+                    seen.add(path)
+                    on_file(path)
+    
+    with get_pool('download').flow(url) as flow:
+        cmd = [megatool_cmd, '--path', temp_folder, *_mega_rate_args(flow.rate()), url]
+        logger.info(f"Downloading Mega folder: {url}")
+        output = deque(maxlen=5)
+        with span('megatools', 'download', url=url):
+            returncode = run_watched(cmd, 'download', on_line=output.append, watch_path=temp_folder,
+                                     on_tick=collect)
+        collect()
+    
+    if returncode != 0:
+        raise Exception(f"Mega folder download failed: {''.join(output).strip() or returncode}")
+    return len(seen)
+
+def _rate_args(rate_limit):
+    # yt-dlp takes bytes/s
+    return ['--limit-rate', str(int(rate_limit))] if rate_limit else []
+
+def _mega_rate_args(rate_limit):
+    # megatools takes KiB/s
+    return ['--limit-speed', str(max(1, int(rate_limit / 1024)))] if rate_limit else []
+
+def _fragment_args():
+    # Parallel fragment fetching for DASH/HLS items (one item, many connections)
+    fragments = load_config(silent=True).get('concurrent_fragments', 4)
+    return ['--concurrent-fragments', str(max(1, int(fragments)))]
+
+def download_from_mega(url, temp_folder=TEMP_FOLDER, rate_limit=None):
     create_folders()
+    os.makedirs(temp_folder, exist_ok=True)
     logger.info(f"Downloading from Mega: {url}")
     print(f"Downloading from Mega: {url}")
     
     try:
-        # Try megatools-dl first, then fall back to megatools
-        megatool_cmd = 'megatools-dl' if shutil.which('megatools-dl') else 'megatools'
+        # megatools-dl if present, otherwise megatools (resolved once by the toolchain probe)
+        megatool_cmd = tool_path('megatools') or 'megatools'
         
         cmd = [
             megatool_cmd,
-            '--path', TEMP_FOLDER,
+            '--path', temp_folder,
+            *_mega_rate_args(rate_limit),
             url
         ]
         
         logger.info("Running megatools download...")
         print("Running megatools download...")
         
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            encoding='utf-8',
-            errors='replace'
-        )
-        
-        for line in process.stdout:
+        def show(line):
             if line.strip():
                 print(line.strip(), flush=True)
         
-        process.wait()
-        
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, cmd)
+        with span('megatools', 'download', url=url):
+            returncode = run_watched(cmd, 'download', on_line=show, watch_path=temp_folder)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
         
         # Find downloaded file
-        downloaded_files = [f for f in os.listdir(TEMP_FOLDER) 
-                           if os.path.isfile(os.path.join(TEMP_FOLDER, f)) and not f.endswith(('.part', '.ytdl', '.temp'))]
+        downloaded_files = [f for f in os.listdir(temp_folder) 
+                           if os.path.isfile(os.path.join(temp_folder, f)) and not f.endswith(('.part', '.ytdl', '.temp'))]
         if not downloaded_files:
             raise Exception("Download completed but no file found")
         
-        file_path = os.path.join(TEMP_FOLDER, max(
+        file_path = os.path.join(temp_folder, max(
             downloaded_files,
-            key=lambda x: os.path.getmtime(os.path.join(TEMP_FOLDER, x))
+            key=lambda x: os.path.getmtime(os.path.join(temp_folder, x))
         ))
         
         logger.info(f"Download completed: {file_path}")
         print(f"Download completed: {file_path}")
         return file_path
         
+    except (StageTimeout, ProcessCancelled) as e:
+        logger.error(f"Mega download stopped: {e}")
+        raise
     except subprocess.CalledProcessError as e:
         logger.error(f"Mega download failed: {e}")
         raise Exception(f"Mega download failed")
@@ -102,9 +364,10 @@ def download_from_mega(url):
         logger.error(f"Mega download error: {str(e)}")
         raise Exception(f"Mega download error: {str(e)}")
 
-def download_with_ytdlp(url, media_type='video'):
+def download_with_ytdlp(url, media_type='video', temp_folder=TEMP_FOLDER, rate_limit=None):
     create_folders()
-    cleanup_temp_files(TEMP_FOLDER)
+    os.makedirs(temp_folder, exist_ok=True)
+    cleanup_temp_files(temp_folder)
     
     logger.info(f"Downloading with yt-dlp: {url}")
     print(f"Downloading with yt-dlp: {url}")
@@ -118,22 +381,25 @@ def download_with_ytdlp(url, media_type='video'):
             logger.info(f"Found: {metadata['title']} by {metadata['artist']}")
             print(f"Found: {metadata['title']} by {metadata['artist']}")
     
+    ytdlp_cmd = tool_path('yt-dlp') or 'yt-dlp'
     try:
         # Generate a safe filename template with ASCII fallback
-        safe_template = os.path.join(TEMP_FOLDER, '%(title).80s.%(ext)s')
+        safe_template = os.path.join(temp_folder, '%(title).80s.%(ext)s')
         
         if media_type == 'music':
             url_type = detect_url_type(url)
             
             if url_type == 'soundcloud':
                 cmd = [
-                    'yt-dlp',
+                    ytdlp_cmd,
                     '--extract-audio',
                     '--audio-format', 'mp3',
                     '--audio-quality', '0',  # Best quality
                     '--no-warnings',
                     '--no-playlist',
                     '--ignore-errors',
+                    *_fragment_args(),
+                    *_rate_args(rate_limit),
                     '--retries', '3',
                     '--fragment-retries', '3',
                     '--embed-metadata',  # Embed metadata in the file
@@ -145,7 +411,7 @@ def download_with_ytdlp(url, media_type='video'):
             else:
                 # For other audio sources
                 cmd = [
-                    'yt-dlp',
+                    ytdlp_cmd,
                     '-f', 'bestaudio/best',
                     '--extract-audio',
                     '--audio-format', 'mp3',
@@ -153,6 +419,8 @@ def download_with_ytdlp(url, media_type='video'):
                     '--no-warnings',
                     '--no-playlist',
                     '--ignore-errors',
+                    *_fragment_args(),
+                    *_rate_args(rate_limit),
                     '--retries', '3',
                     '--embed-metadata',  # Embed metadata in the file
                     '--add-metadata',    # Add metadata
@@ -161,13 +429,25 @@ def download_with_ytdlp(url, media_type='video'):
                     url
                 ]
         else:
-            # For video
+            # For video: pick the format that is cheapest to get onto the Vita
+            format_spec = 'best[height<=720]/best'  # Limit to 720p for Vita compatibility
+            info = get_video_info(url)
+            choice = select_vita_format(info) if info else None
+            if choice:
+                format_spec = f"{choice[0]}/{format_spec}"
+                logger.info(f"Selected format {choice[0]} ({choice[2]}), estimated cost {choice[1]:.0f}s")
+                print(f"Selected format {choice[0]} ({choice[2]}), estimated cost {choice[1]:.0f}s")
+            else:
+                logger.info(f"No format metadata, using {format_spec}")
+            
             cmd = [
-                'yt-dlp',
-                '-f', 'best[height<=720]/best',  # Limit to 720p for Vita compatibility
+                ytdlp_cmd,
+                '-f', format_spec,
                 '--no-warnings',
                 '--no-playlist',
                 '--ignore-errors',
+                *_fragment_args(),
+                *_rate_args(rate_limit),
                 '--retries', '3',
                 '--restrict-filenames',  # Use ASCII-safe filenames
                 '-o', safe_template,
@@ -177,36 +457,28 @@ def download_with_ytdlp(url, media_type='video'):
         logger.info("Running yt-dlp download...")
         print("Running yt-dlp download...")
         
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            encoding='utf-8',
-            errors='replace'
-        )
-        
         # Show real-time download progress
-        for line in process.stdout:
+        def show(line):
             if line.strip():  # Only print non-empty lines
                 if '[download]' in line or 'ERROR:' in line or 'WARNING:' in line:
                     print(line.strip(), flush=True)
         
-        process.wait()
-        
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, cmd)
+        # The temp folder grows with the .part files; a stall is no growth and no output
+        with span('yt-dlp', 'download', url=url):
+            returncode = run_watched(cmd, 'download', on_line=show, watch_path=temp_folder)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
         
         # Wait a moment for file system to sync
         time.sleep(2)
         
         # Clean up any partial files first
-        cleanup_temp_files(TEMP_FOLDER)
+        cleanup_temp_files(temp_folder)
         
         # Find downloaded file
         downloaded_files = []
-        for f in os.listdir(TEMP_FOLDER):
-            full_path = os.path.join(TEMP_FOLDER, f)
+        for f in os.listdir(temp_folder):
+            full_path = os.path.join(temp_folder, f)
             if (os.path.isfile(full_path) and 
                 not f.endswith(('.part', '.ytdl', '.temp')) and
                 not f.startswith('.') and
@@ -217,12 +489,13 @@ def download_with_ytdlp(url, media_type='video'):
             raise Exception("Download completed but no valid file found")
         
         # Get the most recently created file
-        file_path = os.path.join(TEMP_FOLDER, max(
+        file_path = os.path.join(temp_folder, max(
             downloaded_files,
-            key=lambda x: os.path.getmtime(os.path.join(TEMP_FOLDER, x))
+            key=lambda x: os.path.getmtime(os.path.join(temp_folder, x))
         ))
         
-        if not verify_media_file(file_path, media_type if media_type == 'video' else 'audio'):
+        if not verify_media_file(file_path, media_type if media_type == 'video' else 'audio',
+                                 verify_tier('download')):
             raise Exception("Downloaded file appears to be corrupted")
         
         if media_type == 'music' and metadata:
@@ -232,24 +505,30 @@ def download_with_ytdlp(url, media_type='video'):
         print(f"Download completed: {file_path}")
         return file_path
         
-    except subprocess.TimeoutExpired:
-        cleanup_temp_files(TEMP_FOLDER)
-        logger.error("Download timed out (5 minutes)")
-        raise Exception("Download timed out (5 minutes)")
+    except (StageTimeout, ProcessCancelled) as e:
+        # The process group is already killed; drop what it left behind
+        cleanup_temp_files(temp_folder)
+        logger.error(f"yt-dlp download stopped: {e}")
+        raise
     except subprocess.CalledProcessError as e:
-        cleanup_temp_files(TEMP_FOLDER)
+        cleanup_temp_files(temp_folder)
         logger.error(f"yt-dlp download failed with code {e.returncode}")
         raise Exception(f"yt-dlp download failed with code {e.returncode}")
     except Exception as e:
-        cleanup_temp_files(TEMP_FOLDER)
+        cleanup_temp_files(temp_folder)
         logger.error(f"yt-dlp download error: {str(e)}")
         raise Exception(f"yt-dlp download error: {str(e)}")
 
-def download_media(url, media_type='video'):
+def download_media(url, media_type='video', temp_folder=TEMP_FOLDER):
     url_type = detect_url_type(url)
     logger.info(f"Downloading {media_type} from {url_type}: {url}")
     
-    if url_type == 'mega':
-        return download_from_mega(url)
-    else:
-        return download_with_ytdlp(url, media_type)
\ No newline at end of file
+    # The downloaders are separate processes, so each gets its fair share of
+    # the download limit as it starts and keeps it for the whole download
+    with get_pool('download').flow(url) as flow:
+        if url_type == 'mega':
+            file_path = download_from_mega(url, temp_folder, flow.rate())
+        else:
+            file_path = download_with_ytdlp(url, media_type, temp_folder, flow.rate())
+    emit('download', bytes=os.path.getsize(file_path), source=url_type)
+    return file_path
\ No newline at end of file
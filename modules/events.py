@@ -0,0 +1,85 @@
+import time
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+# In-process event bus. Stages publish what they do (spans, history
+# records, job updates); the trace recorder and other observers subscribe.
+# Callbacks run synchronously on the publishing thread, so they must be
+# quick. With no subscribers, publishing costs one list check.
+
+log = logging.getLogger(__name__)
+
+_subscribers = []
+_lock = threading.Lock()
+_local = threading.local()
+
+def subscribe(callback):
+    # callback(kind, fields)
+    with _lock:
+        _subscribers.append(callback)
+
+def unsubscribe(callback):
+    with _lock:
+        if callback in _subscribers:
+            _subscribers.remove(callback)
+
+def emit(kind, **fields):
+    if not _subscribers:
+        return
+    job = getattr(_local, 'job', None)
+    if job and 'job' not in fields:
+        fields['job'], fields['job_label'] = job
+    fields.setdefault('thread', threading.current_thread().name)
+    for callback in list(_subscribers):
+        try:
+            callback(kind, fields)
+        except Exception as e:
+            log.warning(f"Event subscriber failed on {kind}: {e}")
+
+@contextmanager
+def job_scope(job_id, label=None):
+    """Events published by this thread inside the block belong to job_id."""
+    previous = getattr(_local, 'job', None)
+    _local.job = (job_id, label)
+    try:
+        yield
+    finally:
+        _local.job = previous
+
+def current_job():
+    # (job id, label) of the job this thread is working on, or None
+    return getattr(_local, 'job', None)
+
+def now():
+    return time.perf_counter()
+
+def record_span(name, category, start, end=None, **args):
+    # For intervals that start on one thread and end on another (queue waits)
+    if _subscribers:
+        job = args.pop('job', None)
+        extra = {'job': job, 'job_label': args.pop('job_label', None)} if job is not None else {}
+        emit('span', name=name, category=category, start=start, end=end or now(), args=args, **extra)
+
+@contextmanager
+def span(name, category, **args):
+    # Yields the span's args; the block may add results (e.g. bytes, media seconds)
+    if not _subscribers:
+        yield args
+        return
+    start = now()
+    try:
+        yield args
+    finally:
+        emit('span', name=name, category=category, start=start, end=now(), args=args)
+
+def traced(name, category):
+    # Decorator: every call is a span
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
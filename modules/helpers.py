@@ -1,53 +1,166 @@
 import os
 import sys
-import shutil
 import subprocess
 import re
 import glob
+import json
+import queue
+import atexit
 import logging
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 from .constants import LOG_FOLDER, TEMP_FOLDER, CONVERTED_FOLDER
+from .events import traced, current_job
 
-# Setup logging
-def setup_logging():
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+# Module-level logger; handlers are attached by setup_logging(), which the
+# CLI calls once. Importing this module has no side effects.
+logger = logging.getLogger(__name__)
+
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+LOG_FORMATS = ('text', 'json')
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that several PSVMP processes (--serve, --watch,
+    a CLI run) can share: each write and rollover holds an OS lock on
+    a .lock file, and the log is reopened after another process rotated it."""
+
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lock_file = None  # opened on the first write, like the log with delay=True
+
+    def _reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            rotated = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except OSError:
+            rotated = True
+        if rotated:
+            self.stream.close()
+            self.stream = self._open()
+
+    def _lock(self, locked):
+        if self.lock_file is None:
+            self.lock_file = open(self.baseFilename + '.lock', 'a+b')
+        if os.name == 'nt':
+            self.lock_file.seek(0)
+            msvcrt.locking(self.lock_file.fileno(), msvcrt.LK_LOCK if locked else msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX if locked else fcntl.LOCK_UN)
+
+    def emit(self, record):
+        try:
+            self._lock(True)
+        except OSError:
+            # Never let a lock failure stop the writer thread
+            self.handleError(record)
+            return
+        try:
+            self._reopen_if_rotated()
+            super().emit(record)
+        finally:
+            self._lock(False)
+
+    def close(self):
+        super().close()
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'job', None) is not None:
+            entry['job'] = record.job
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class _JobFilter(logging.Filter):
+    # Runs on the logging thread, where the job scope is known
+    def filter(self, record):
+        job = current_job()
+        record.job = job[0] if job else None
+        record.job_tag = f"[job {job[0]}] " if job else ''
+        return True
+
+_listener = None
+
+def _stop_logging():
+    # Flushes what is still queued
+    global _listener
+    if _listener:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+def setup_logging(level=None, log_format=None):
+    """Route all logging through a queue to one writer thread, so stages
+    never wait on the disk (or on a rollover). level and log_format
+    default to log_level and log_format from the config."""
+    global _listener
+    if level is None or log_format is None:
+        from .config import load_config
+        config = load_config(silent=True)
+        level = level or config.get('log_level', 'info')
+        log_format = log_format or config.get('log_format', 'text')
+    
     log_filename = "psvmp.log"
     log_filepath = os.path.join(LOG_FOLDER, log_filename)
+    os.makedirs(LOG_FOLDER, exist_ok=True)
     
+    _stop_logging()
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
+        handler.close()
     
-    file_handler = RotatingFileHandler(
+    # delay=True: the log file is only opened once something is logged
+    file_handler = SharedRotatingFileHandler(
         log_filepath,
         maxBytes=5*1024*1024,  # 5MB
         backupCount=3,          # keep 3 backup files
-        encoding='utf-8'
+        encoding='utf-8',
+        delay=True
     )
     
     # Config logging format
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+    if log_format == 'json':
+        formatter = JsonLineFormatter()
+    else:
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(job_tag)s%(message)s'
+        )
     file_handler.setFormatter(formatter)
     
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))  # the writer adds the rest
+    queue_handler.addFilter(_JobFilter())
+    _listener = QueueListener(queue_handler.queue, file_handler)
+    _listener.start()
+    atexit.register(_stop_logging)
+    
     # Config root logger
     logging.basicConfig(
-        level=logging.INFO,
-        handlers=[file_handler],
+        level=getattr(logging, level.upper(), logging.INFO),
+        handlers=[queue_handler],
         force=True
     )
     
-    logger = logging.getLogger(__name__)
-    logger.info("=" * 50)
-    logger.info(f"PS Vita Media Processor started")
-    logger.info(f"Log file: {log_filepath}")
-    logger.info("=" * 50)
-    
     return logger
 
-logger = setup_logging()
-
 def sanitize_filename(filename):
     if not filename:
         return "unknown"
@@ -64,6 +177,14 @@ def sanitize_filename(filename):
     
     return filename.strip()
 
+def parse_size(text):
+    # "700M", "1.5G", "800MB", "1048576" -> bytes
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', str(text), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size: {text}")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(unit.upper() or ' '))
+
 def create_folders():
     os.makedirs(TEMP_FOLDER, exist_ok=True)
     os.makedirs(CONVERTED_FOLDER, exist_ok=True)
@@ -79,21 +200,14 @@ def cleanup_temp_files(folder_path):
             except Exception as e:
                 logger.warning(f"Failed to clean up {file}: {e}")
 
-def check_dependencies():
-    missing_tools = []
-    
-    # Check for megatools (either megatools-dl or megatools)
-    if not shutil.which('megatools-dl') and not shutil.which('megatools'):
-        missing_tools.append('megatools')
+def check_dependencies(media_types=('video', 'music'), video_encoder='libx264', refresh=False):
+    # Tool paths, versions and ffmpeg encoders/muxers are probed once and
+    # cached (see toolchain.py), so this is cheap to call before every job
+    from .toolchain import get_toolchain, missing_capabilities
     
-    # Check for yt-dlp
-    if not shutil.which('yt-dlp'):
-        missing_tools.append('yt-dlp')
-    
-    # Check for ffmpeg and ffprobe
-    for tool in ['ffmpeg', 'ffprobe']:
-        if not shutil.which(tool):
-            missing_tools.append(tool)
+    toolchain = get_toolchain(refresh=refresh)
+    missing_tools = [tool for tool in ('megatools', 'yt-dlp') if tool not in toolchain['tools']]
+    missing_tools += missing_capabilities(media_types, video_encoder)
     
     if missing_tools:
         logger.error(f"Missing required tools: {', '.join(missing_tools)}")
@@ -101,7 +215,7 @@ def check_dependencies():
         print("\nInstall instructions:")
         print("- megatools: https://megatools.megous.com/ or package manager")
         print("- yt-dlp: pip install yt-dlp")
-        print("- ffmpeg: https://ffmpeg.org/ or package manager")
+        print("- ffmpeg: https://ffmpeg.org/ or package manager (with libmp3lame and aac)")
         return False
     return True
 
@@ -117,15 +231,130 @@ def detect_url_type(url):
     else:
         return 'other'
 
-def verify_media_file(file_path, media_type='video'):
-    try:
-        cmd = ['ffprobe', '-v', 'error', '-show_format', '-show_streams', file_path]
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        logger.info(f"Verified {media_type} file: {os.path.basename(file_path)}")
-        return True
-    except subprocess.CalledProcessError as e:
-        logger.error(f"File verification failed for {file_path}: {e}")
+# Integrity tiers: "fast" reads container headers only, "standard" runs
+# ffprobe, "deep" decodes the whole file to null in parallel segments.
+VERIFY_TIERS = ('fast', 'standard', 'deep')
+MIN_MEDIA_SIZE = 1024
+HEADER_SIGNATURES = (
+    (0, b'\x1a\x45\xdf\xa3'),  # Matroska / WebM
+    (0, b'ID3'),               # MP3 with ID3 tag
+    (0, b'fLaC'),
+    (0, b'OggS'),
+    (0, b'RIFF'),              # WAV / AVI
+    (0, b'FLV'),
+    (0, b'\x30\x26\xb2\x75'),  # ASF / WMV / WMA
+    (0, b'\x00\x00\x01\xba'),  # MPEG program stream
+)
+DEEP_SEGMENT_MIN_SECONDS = 30
+
+def _walk_mp4_boxes(f, size):
+    # Top-level boxes must tile the file exactly; a truncated download or
+    # upload leaves the last box short, and a file without moov is unplayable
+    offset, boxes = 0, set()
+    while offset < size:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return False
+        box_size = int.from_bytes(header[:4], 'big')
+        if box_size == 1:
+            box_size = int.from_bytes(f.read(8), 'big')
+        elif box_size == 0:
+            box_size = size - offset
+        if box_size < 8:
+            return False
+        boxes.add(header[4:8])
+        offset += box_size
+    return offset == size and b'moov' in boxes
+
+def _check_header(file_path):
+    """True/False from the container header, or None for an unknown container."""
+    size = os.path.getsize(file_path)
+    if size < MIN_MEDIA_SIZE:
+        return False
+    with open(file_path, 'rb') as f:
+        head = f.read(16)
+        if head[4:8] == b'ftyp':
+            return _walk_mp4_boxes(f, size)
+    if head[0] == 0x47 and size > 188:
+        with open(file_path, 'rb') as f:
+            f.seek(188)
+            return f.read(1) == b'\x47'  # MPEG-TS sync bytes
+    if head[0] == 0xff and head[1] & 0xe0 == 0xe0:
+        return True  # MP3 / ADTS AAC frame sync
+    for offset, magic in HEADER_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return True
+    return None
+
+def _decode_check(file_path):
+    from concurrent.futures import ThreadPoolExecutor
+    
+    probe = probe_media(file_path)
+    if probe is None:
         return False
+    duration = float(probe.get('format', {}).get('duration') or 0)
+    segments = max(1, min(os.cpu_count() or 1, int(duration // DEEP_SEGMENT_MIN_SECONDS)))
+    length = duration / segments if duration else None
+    
+    def decode(index):
+        cmd = ['ffmpeg', '-v', 'error', '-xerror']
+        if length:
+            cmd += ['-ss', f"{index * length:.3f}", '-t', f"{length:.3f}"]
+        cmd += ['-i', file_path, '-f', 'null', '-']
+        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
+        if result.returncode != 0 or result.stderr.strip():
+            logger.error(f"Decode check failed for {os.path.basename(file_path)} "
+                         f"segment {index + 1}/{segments}: {result.stderr.strip()[:500]}")
+            return False
+        return True
+    
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        return all(pool.map(decode, range(segments)))
+
+@traced('verify', 'verify')
+def verify_media_file(file_path, media_type='video', tier='standard', probe=None):
+    # probe: a probe_media() result the caller already has, saving the standard tier's ffprobe run
+    if tier == 'fast':
+        try:
+            header_ok = _check_header(file_path)
+        except OSError as e:
+            logger.error(f"File verification failed for {file_path}: {e}")
+            return False
+        if header_ok is not None:
+            if header_ok:
+                logger.info(f"Verified {media_type} file (headers): {os.path.basename(file_path)}")
+            else:
+                logger.error(f"File verification failed for {file_path}: bad or truncated container")
+            return header_ok
+        # Unknown container: fall through to ffprobe
+    
+    if tier == 'deep':
+        # probes for the duration itself, so no separate ffprobe run
+        if not _decode_check(file_path):
+            logger.error(f"File verification failed for {file_path}: decode errors")
+            return False
+    elif probe is None:
+        try:
+            cmd = ['ffprobe', '-v', 'error', '-show_format', '-show_streams', file_path]
+            result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as e:
+            logger.error(f"File verification failed for {file_path}: {e}")
+            return False
+    logger.info(f"Verified {media_type} file: {os.path.basename(file_path)}")
+    return True
+
+@traced('probe', 'probe')
+def probe_media(file_path):
+    # ffprobe format and stream info as a dict, or None if the file can't be read
+    cmd = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', file_path]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8', errors='replace')
+        if result.returncode == 0:
+            return json.loads(result.stdout)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not probe {file_path}: {e}")
+    return None
     
 def check_logs_exist():
     if os.path.exists(LOG_FOLDER):
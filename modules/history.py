@@ -4,8 +4,9 @@ from datetime import datetime
 
 from .constants import HISTORY_FILE, PSVMP_DIR
 from .helpers import logger
+from .events import emit
 
-def log_to_history(url, media_type, status="completed", error_message=None):
+def log_to_history(url, media_type, status="completed", error_message=None, target=None, **details):
     try:
         os.makedirs(PSVMP_DIR, exist_ok=True)
         
@@ -20,11 +21,15 @@ def log_to_history(url, media_type, status="completed", error_message=None):
             'status': status,
             'error': error_message
         }
+        if target:
+            entry['target'] = target
+        entry.update(details)
+        emit('history', **entry)
         
         with open(HISTORY_FILE, 'a', encoding='utf-8') as f:
             f.write(json.dumps(entry, ensure_ascii=False) + '\n')
         
-        logger.info(f"Logged to history: {url} ({media_type}) - {status}")
+        logger.info(f"Logged to history: {url} ({media_type}) - {status}" + (f" [{target}]" if target else ""))
         
     except Exception as e:
         logger.error(f"Failed to write to history file: {e}")
@@ -55,6 +60,20 @@ def read_history(limit=None):
         logger.error(f"Failed to read history file: {e}")
         return []
 
+def completed_targets(fingerprint):
+    # Targets that already received the source with this fingerprint
+    return {entry.get('target') for entry in read_history()
+            if entry.get('fingerprint') == fingerprint and entry.get('status') == 'completed'}
+
+def evictable_files():
+    # Converted files delivered at least once and never held or failed for
+    # any Vita; entries carry 'file' from the transfer step
+    delivered, pending = set(), set()
+    for entry in read_history():
+        if entry.get('file'):
+            (delivered if entry.get('status') == 'completed' else pending).add(entry['file'])
+    return delivered - pending
+
 def clear_history():
     try:
         if os.path.exists(HISTORY_FILE):
@@ -82,6 +101,14 @@ def show_history(limit=10):
         
         print(f"{i}. [{timestamp}] {status_icon} {entry['media_type'].upper()}")
         print(f"   URL: {entry['url']}")
+        if entry.get('target'):
+            print(f"   Vita: {entry['target']}")
+        if entry.get('sha256'):
+            check = "size verified" if entry.get('verified') else "not verified"
+            print(f"   SHA-256: {entry['sha256'][:16]}... ({check})")
+        if entry.get('failures'):
+            counts = ", ".join(f"{reason} x{count}" for reason, count in entry['failures'].items())
+            print(f"   Failed FTP attempts: {counts}")
         if entry['status'] != 'completed' and entry.get('error'):
             print(f"   Error: {entry['error']}")
         print()
\ No newline at end of file
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from .constants import PSVMP_DIR
+
+QUEUE_FILE = os.path.join(PSVMP_DIR, "jobs.db")
+
+FINAL_STATES = ('completed', 'failed', 'held', 'cancelled')
+PRIORITIES = ('high', 'normal', 'low')  # lanes, most urgent first
+
+# Oldest job of the most urgent lane first
+_CLAIM_ORDER = "CASE priority " + " ".join(f"WHEN '{p}' THEN {i}" for i, p in enumerate(PRIORITIES)) + " END, id"
+
+class JobQueue:
+    # Persistent job list; survives restarts of the service
+    def __init__(self, path=QUEUE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    media_type TEXT NOT NULL,
+                    targets TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    stage TEXT,
+                    progress TEXT,
+                    error TEXT,
+                    options TEXT NOT NULL DEFAULT '{}',
+                    priority TEXT NOT NULL DEFAULT 'normal',
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            columns = [row[1] for row in db.execute("PRAGMA table_info(jobs)")]
+            if 'options' not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN options TEXT NOT NULL DEFAULT '{}'")
+            if 'priority' not in columns:
+                db.execute("ALTER TABLE jobs ADD COLUMN priority TEXT NOT NULL DEFAULT 'normal'")
+            # Jobs interrupted by a restart start over
+            db.execute("UPDATE jobs SET state = 'queued', stage = NULL WHERE state NOT IN (?, ?, ?, ?)",
+                       FINAL_STATES)
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def submit(self, url, media_type, targets, options=None, priority='normal'):
+        now = time.time()
+        with self.lock, self._connect() as db:
+            cursor = db.execute(
+                "INSERT INTO jobs (url, media_type, targets, options, priority, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, media_type, json.dumps(targets), json.dumps(options or {}), priority, now, now)
+            )
+            return cursor.lastrowid
+
+    def claim_next(self, priorities=PRIORITIES):
+        # Only jobs in the given lanes are claimed
+        lanes = ", ".join("?" * len(priorities))
+        with self.lock, self._connect() as db:
+            row = db.execute(f"SELECT id FROM jobs WHERE state = 'queued' AND priority IN ({lanes}) "
+                             f"ORDER BY {_CLAIM_ORDER} LIMIT 1", priorities).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE jobs SET state = 'starting', updated = ? WHERE id = ?", (time.time(), row[0]))
+        return self.get(row[0])
+
+    def update(self, job_id, **fields):
+        fields = {k: v for k, v in fields.items() if k in ('state', 'stage', 'progress', 'error')}
+        if not fields:
+            return
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self.lock, self._connect() as db:
+            db.execute(f"UPDATE jobs SET {assignments}, updated = ? WHERE id = ?",
+                       (*fields.values(), time.time(), job_id))
+
+    def cancel(self, job_id):
+        # Only queued jobs are cancelled here; running ones are stopped by the scheduler
+        with self.lock, self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET state = 'cancelled', updated = ? WHERE id = ? AND state = 'queued'",
+                                (time.time(), job_id))
+            return cursor.rowcount > 0
+
+    def get(self, job_id):
+        with self._connect() as db:
+            db.row_factory = sqlite3.Row
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list(self, state=None, limit=100):
+        query = "SELECT * FROM jobs"
+        params = []
+        if state:
+            query += " WHERE state = ?"
+            params.append(state)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        with self._connect() as db:
+            db.row_factory = sqlite3.Row
+            rows = db.execute(query, params).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def count_by_state(self):
+        with self._connect() as db:
+            return dict(db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def _to_dict(self, row):
+        job = dict(row)
+        job['targets'] = [tuple(target) for target in json.loads(job['targets'])]
+        job['options'] = json.loads(job['options'])
+        return job
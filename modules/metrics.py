@@ -0,0 +1,219 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import events
+from .helpers import logger
+
+# Prometheus text-format metrics, fed from the event bus: history records,
+# job state changes, stage spans, downloads, cache lookups and FTP retries.
+# Recording is a dict update under one lock per event.
+
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600)
+REALTIME_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    # Exact: byte counters pass a million right away and must not be rounded
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    return str(int(value)) if value.is_integer() and abs(value) < 2 ** 53 else repr(value)
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_label_text(self.labels, key)} {_number(value)}")
+        return lines
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            # per-bucket counts (last one is +Inf), then sum
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ('le',)
+        for key, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append(f"{self.name}_bucket{_label_text(names, key + (bound,))} {total}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {total}")
+        return lines
+
+class MetricsRecorder:
+    """Event bus subscriber keeping the metrics below."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.job_states = {}  # job id -> current state, for jobs still in the scheduler
+        self.collectors = []  # (metric, collect) pairs; collect(metric) refreshes it at scrape time
+        self.jobs = Counter('psvmp_jobs_total', 'Jobs that reached a final state', ('state',))
+        self.active = Gauge('psvmp_jobs', 'Jobs in the scheduler by state', ('state',))
+        self.history = Counter('psvmp_history_records_total', 'History records written',
+                               ('status', 'media_type'))
+        self.stage_seconds = Histogram('psvmp_stage_duration_seconds', 'Time spent in each stage', ('stage',))
+        self.queue_seconds = Histogram('psvmp_queue_wait_seconds', 'Time jobs waited for a stage worker',
+                                       ('stage',), WAIT_BUCKETS)
+        self.queue_depth = Gauge('psvmp_queue_depth', 'Jobs waiting for a stage worker', ('stage',))
+        self.realtime = Histogram('psvmp_encode_realtime_factor',
+                                  'Seconds of media encoded per second of wall time', (), REALTIME_BUCKETS)
+        self.downloaded = Counter('psvmp_downloaded_bytes_total', 'Bytes downloaded', ('source',))
+        self.uploaded = Counter('psvmp_uploaded_bytes_total', 'Bytes uploaded to a PS Vita', ('target',))
+        self.ftp_retries = Counter('psvmp_ftp_retries_total', 'Failed FTP upload attempts that were retried',
+                                   ('target', 'reason'))
+        self.cache = Counter('psvmp_cache_lookups_total', 'Cache lookups', ('cache', 'result'))
+        self.metrics = [self.jobs, self.active, self.history, self.stage_seconds, self.queue_seconds,
+                        self.queue_depth, self.realtime, self.downloaded, self.uploaded, self.ftp_retries,
+                        self.cache]
+
+    def __call__(self, kind, fields):
+        handler = getattr(self, f"_on_{kind}", None)
+        if handler:
+            with self.lock:
+                handler(fields)
+
+    def _on_job(self, fields):
+        job_id, state = fields['job'], fields['state']
+        if state in ('completed', 'failed', 'held', 'cancelled'):
+            self.job_states.pop(job_id, None)
+            self.jobs.inc(state=state)
+        else:
+            self.job_states[job_id] = state
+
+    def _on_history(self, fields):
+        self.history.inc(status=fields['status'], media_type=fields['media_type'])
+        if fields['status'] == 'completed' and fields.get('bytes'):
+            self.uploaded.inc(fields['bytes'], target=fields.get('target', ''))
+
+    def _on_span(self, fields):
+        duration = fields['end'] - fields['start']
+        args = fields.get('args') or {}
+        if fields['category'] == 'stage':
+            self.stage_seconds.observe(duration, stage=fields['name'])
+        elif fields['category'] == 'queue' and args.get('stage'):
+            self.queue_seconds.observe(duration, stage=args['stage'])
+        elif fields['name'] == 'encode' and args.get('media_seconds') and duration > 0:
+            self.realtime.observe(args['media_seconds'] / duration)
+
+    def _on_queue(self, fields):
+        self.queue_depth.inc(fields['change'], stage=fields['stage'])
+
+    def _on_download(self, fields):
+        self.downloaded.inc(fields['bytes'], source=fields['source'])
+
+    def _on_ftp_retry(self, fields):
+        self.ftp_retries.inc(target=fields['target'], reason=fields.get('reason', ''))
+
+    def _on_cache(self, fields):
+        self.cache.inc(cache=fields['cache'], result='hit' if fields['hit'] else 'miss')
+
+    def register(self, metric, collect=None):
+        with self.lock:
+            self.metrics.append(metric)
+            if collect:
+                self.collectors.append((metric, collect))
+
+    def render(self):
+        for metric, collect in list(self.collectors):
+            try:
+                collect(metric)
+            except Exception as e:
+                logger.warning(f"Metrics collector for {metric.name} failed: {e}")
+        with self.lock:
+            self.active.values = {}
+            for state in self.job_states.values():
+                self.active.inc(state=state)
+            lines = []
+            for metric in self.metrics:
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+def enable_metrics():
+    # Start recording (once per process) and return the recorder
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = MetricsRecorder()
+            events.subscribe(_recorder)
+        return _recorder
+
+def serve_metrics(host='127.0.0.1', port=9108):
+    """Standalone /metrics endpoint in a background thread, for modes
+    without the job service (--watch, playlists)."""
+    recorder = enable_metrics()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split('?')[0].rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = recorder.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return httpd
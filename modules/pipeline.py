@@ -0,0 +1,80 @@
+import os
+import hashlib
+
+from .constants import CONVERTED_FOLDER, VITA_VIDEO_PATH, VITA_MUSIC_PATH
+from .conversion import convert_for_vita_video, convert_for_vita_music
+from .transfer import VitaFTP, fanout_transfer
+from .cache import file_fingerprint, lookup_converted, store_converted
+from .helpers import sanitize_filename, create_folders
+from .toolchain import pick_video_encoder
+from .config import load_config
+
+VIDEO_EXTENSIONS = ('.mp4', '.m4v', '.mkv', '.avi', '.mov', '.webm', '.flv', '.wmv', '.ts', '.mpg', '.mpeg')
+AUDIO_EXTENSIONS = ('.mp3', '.flac', '.wav', '.m4a', '.aac', '.ogg', '.opus', '.wma')
+
+def media_type_for_file(file_path):
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext in VIDEO_EXTENSIONS:
+        return 'video'
+    if ext in AUDIO_EXTENSIONS:
+        return 'music'
+    return None
+
+def list_media_folder(folder, media_type):
+    # Files of one media type in a local folder, as playlist entries
+    entries = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path) and media_type_for_file(path) == media_type:
+            entries.append({'url': path, 'title': name, 'duration': None})
+    return entries
+
+def get_output_settings(media_type):
+    if media_type == 'music':
+        return ".mp3", VITA_MUSIC_PATH, convert_for_vita_music
+    return "_psvita.mp4", VITA_VIDEO_PATH, convert_for_vita_video
+
+def convert_media(input_file, media_type, fingerprint=None, video_encoder=None, target_size=None, two_pass=False,
+                  quiet=False):
+    output_extension, _, conversion_func = get_output_settings(media_type)
+    variant = f"size={target_size}" if media_type == 'video' and target_size else None
+    
+    fingerprint = fingerprint or file_fingerprint(input_file)
+    cached = lookup_converted(fingerprint, media_type, variant)
+    if cached:
+        print(f"Using cached conversion: {os.path.basename(cached)}")
+        return cached
+    
+    create_folders()
+    # Sources with the same name (video.mp4 from two playlists) and size
+    # variants of one source must not overwrite each other
+    tag = hashlib.sha1(f"{fingerprint}|{variant}".encode()).hexdigest()[:8]
+    base_name = sanitize_filename(os.path.splitext(os.path.basename(input_file))[0])
+    output_path = os.path.join(CONVERTED_FOLDER, f"{base_name}_{tag}{output_extension}")
+    
+    if media_type == 'music':
+        converted_file = conversion_func(input_file, output_path, quiet)
+    else:
+        preference = video_encoder or load_config(silent=True)['video_encoder']
+        converted_file = conversion_func(input_file, output_path, pick_video_encoder(preference),
+                                         target_size, two_pass)
+    store_converted(fingerprint, media_type, input_file, converted_file, variant)
+    return converted_file
+
+def transfer_media(converted_file, targets, media_type, progress_callback=None):
+    # Returns {(ip, port): (ok, error, upload)} for every target, where upload
+    # is {'sha256', 'bytes', 'verified', 'failures'} for the history; on
+    # failure it is {'reason', 'failures'} or None
+    _, vita_path, _ = get_output_settings(media_type)
+    remote_path = f"{vita_path}{os.path.basename(converted_file)}"
+    verify = load_config(silent=True)['verify_upload']
+    
+    if len(targets) > 1:
+        return fanout_transfer(converted_file, remote_path, targets, progress_callback, verify=verify)
+    
+    ip, port = targets[0]
+    try:
+        upload = VitaFTP(ip, port).transfer(converted_file, remote_path, progress_callback, verify=verify)
+        return {(ip, port): (True, None, upload)}
+    except Exception as e:
+        return {(ip, port): (False, str(e), getattr(e, 'details', None))}
@@ -0,0 +1,170 @@
+import os
+import time
+import queue
+import signal
+import threading
+import subprocess
+from contextlib import contextmanager
+
+from .helpers import logger
+from .config import load_config
+from .storage import folder_usage
+
+class StageTimeout(Exception):
+    # The stage ran past its deadline or stopped making progress; may be retried
+    pass
+
+class ProcessCancelled(Exception):
+    pass
+
+STAGE_TIMEOUT_KEYS = {'download': 'download_timeout', 'convert': 'convert_timeout'}
+KILL_GRACE = 5  # seconds between SIGTERM and SIGKILL
+TICK = 1  # seconds between checks of the deadline, the watched path and on_tick
+CAN_PAUSE = hasattr(signal, 'SIGSTOP')  # POSIX only; Windows has no job-control signals
+
+_local = threading.local()
+
+def _new_context(stage, cancel_event=None):
+    timeout = load_config(silent=True).get(STAGE_TIMEOUT_KEYS.get(stage)) if stage else None
+    return {'stage': stage, 'timeout': timeout, 'cancel': cancel_event,
+            'deadline': time.monotonic() + timeout if timeout else None,
+            'process': None, 'pauses': 0, 'lock': threading.Lock()}
+
+@contextmanager
+def stage_context(stage, cancel_event=None):
+    """Child processes started by this thread inside the block share one
+    deadline for the whole stage and are killed once cancel_event is set."""
+    previous = getattr(_local, 'context', None)
+    _local.context = _new_context(stage, cancel_event)
+    try:
+        yield _local.context
+    finally:
+        _local.context = previous
+
+def _signal_group(process, signum):
+    try:
+        os.killpg(process.pid, signum)
+    except ProcessLookupError:
+        pass
+
+def pause_stage(context):
+    """Stop the stage's child process (and its group) until resume_stage().
+    Pauses nest; a process started while paused starts stopped."""
+    if not CAN_PAUSE:
+        return False
+    with context['lock']:
+        context['pauses'] += 1
+        if context['pauses'] == 1 and context['process']:
+            _signal_group(context['process'], signal.SIGSTOP)
+    return True
+
+def resume_stage(context):
+    with context['lock']:
+        context['pauses'] -= 1
+        if context['pauses'] == 0 and context['process']:
+            _signal_group(context['process'], signal.SIGCONT)
+
+def _group_args():
+    # Own process group, so yt-dlp's ffmpeg and megatools' helpers die with them
+    if os.name == 'nt':
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+def kill_process_tree(process):
+    if process.poll() is not None:
+        return
+    logger.info(f"Killing process group of {process.pid}")
+    if os.name == 'nt':
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            if CAN_PAUSE:
+                os.killpg(process.pid, signal.SIGCONT)  # a paused process only sees SIGTERM once resumed
+            try:
+                process.wait(KILL_GRACE)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    process.wait()  # reap it; no zombies
+
+def _path_size(path):
+    if not path:
+        return 0
+    if os.path.isdir(path):
+        return folder_usage(path)
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def run_watched(cmd, stage=None, on_line=None, watch_path=None, on_tick=None):
+    """Run cmd with stdout and stderr merged, passing each line to on_line.
+
+    The process is killed (with its whole group) when the stage deadline
+    passes, when neither a new output line nor growth of watch_path has
+    been seen for stall_timeout seconds, or when the job is cancelled.
+    Inside stage_context() the stage's deadline and cancel event apply;
+    otherwise the deadline for `stage` starts now. While the stage is
+    paused, the deadline and the stall clock stop. Returns the exit code.
+    """
+    context = getattr(_local, 'context', None) or _new_context(stage)
+    stall_timeout = load_config(silent=True).get('stall_timeout')
+
+    with context['lock']:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   universal_newlines=True, encoding='utf-8', errors='replace', **_group_args())
+        context['process'] = process
+        if context['pauses']:
+            _signal_group(process, signal.SIGSTOP)
+    lines = queue.Queue()
+
+    def read():
+        for line in process.stdout:
+            lines.put(line)
+        lines.put(None)
+    threading.Thread(target=read, name='process-reader', daemon=True).start()
+
+    last_line, last_size = None, _path_size(watch_path)
+    last_progress = last_tick = time.monotonic()
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=TICK)
+            except queue.Empty:
+                line = ''
+            if line is None:
+                break
+            now = time.monotonic()
+            if line:
+                # ffmpeg repeats its last stats line while stuck; only new output counts
+                if line != last_line:
+                    last_line, last_progress = line, now
+                if on_line:
+                    on_line(line)
+            if now - last_tick < TICK:
+                continue
+            if context['pauses']:
+                if context['deadline']:
+                    context['deadline'] += now - last_tick
+                last_progress = now
+            last_tick = now
+
+            size = _path_size(watch_path)
+            if size != last_size:
+                last_size, last_progress = size, now
+            if on_tick:
+                on_tick()
+
+            if context['cancel'] is not None and context['cancel'].is_set():
+                raise ProcessCancelled(f"{os.path.basename(cmd[0])} cancelled")
+            if context['deadline'] and now > context['deadline']:
+                raise StageTimeout(f"{context['stage']} took longer than {context['timeout']}s")
+            if stall_timeout and now - last_progress > stall_timeout:
+                raise StageTimeout(f"{os.path.basename(cmd[0])} made no progress for {stall_timeout}s")
+        return process.wait()
+    finally:
+        with context['lock']:
+            context['process'] = None
+        kill_process_tree(process)
@@ -0,0 +1,110 @@
+import time
+import threading
+from contextlib import contextmanager
+
+from .helpers import logger, parse_size
+
+LIMIT_KEYS = {
+    'download': ('download_limit', 'job_download_limit'),
+    'upload': ('upload_limit', 'job_upload_limit'),
+}
+BURST_SECONDS = 0.5  # how far a flow may run ahead after being idle
+
+class Flow:
+    """One job's transfer in a BandwidthPool; a token bucket whose rate is
+    the flow's current fair share, so it adapts as flows come and go."""
+
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+        self.tokens = 0.0
+        self.last = time.monotonic()
+
+    def rate(self):
+        return self.pool.share()
+
+    def consume(self, nbytes):
+        rate = self.pool.share()
+        if not rate:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.last) * rate, rate * BURST_SECONDS)
+        self.last = now
+        self.tokens -= nbytes
+        if self.tokens < 0:
+            time.sleep(-self.tokens / rate)
+
+class BandwidthPool:
+    """Global limit shared equally by the active flows, each also capped by
+    the per-job limit. Limits are bytes/s, None for unlimited."""
+
+    def __init__(self, name, total=None, per_job=None):
+        self.name = name
+        self.total = total
+        self.per_job = per_job
+        self.flows = set()
+        self.lock = threading.Lock()
+
+    def set_limits(self, total=None, per_job=None):
+        with self.lock:
+            self.total = total
+            self.per_job = per_job
+        logger.info(f"{self.name} limits: total={total} per_job={per_job} (bytes/s)")
+
+    def share(self):
+        with self.lock:
+            shares = [limit for limit in (self.per_job,) if limit]
+            if self.total:
+                shares.append(self.total / max(1, len(self.flows)))
+        return min(shares) if shares else None
+
+    @contextmanager
+    def flow(self, name=None):
+        flow = Flow(self, name)
+        with self.lock:
+            self.flows.add(flow)
+        try:
+            yield flow
+        finally:
+            with self.lock:
+                self.flows.discard(flow)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _parse_limit(value):
+    if value is None or str(value).strip().lower() in ('', '0', 'none'):
+        return None
+    return int(value) if isinstance(value, (int, float)) else parse_size(str(value))
+
+def get_pool(kind):
+    # 'download' or 'upload'; configured from the config file on first use
+    with _pools_lock:
+        if kind not in _pools:
+            from .config import load_config
+            config = load_config(silent=True)
+            total_key, job_key = LIMIT_KEYS[kind]
+            _pools[kind] = BandwidthPool(kind, _parse_limit(config.get(total_key)),
+                                         _parse_limit(config.get(job_key)))
+        return _pools[kind]
+
+def get_limits():
+    limits = {}
+    for kind, (total_key, job_key) in LIMIT_KEYS.items():
+        pool = get_pool(kind)
+        limits[total_key] = pool.total
+        limits[job_key] = pool.per_job
+    return limits
+
+def set_limits(values):
+    # values: any of the config key names, as bytes/s or sizes like "2M"; takes effect immediately
+    known = {key for keys in LIMIT_KEYS.values() for key in keys}
+    unknown = set(values) - known
+    if unknown:
+        raise ValueError(f"unknown limit(s): {', '.join(sorted(unknown))}")
+    parsed = {key: _parse_limit(value) for key, value in values.items()}  # all or nothing
+    for kind, (total_key, job_key) in LIMIT_KEYS.items():
+        if total_key in parsed or job_key in parsed:
+            pool = get_pool(kind)
+            pool.set_limits(parsed.get(total_key, pool.total), parsed.get(job_key, pool.per_job))
+    return get_limits()
@@ -0,0 +1,433 @@
+import os
+import queue
+import shutil
+import tempfile
+import itertools
+import threading
+
+from .constants import TEMP_FOLDER
+from .download import download_media, get_video_info
+from .transfer import start_preflight
+from .pipeline import get_output_settings, convert_media, transfer_media
+from .history import log_to_history
+from .cache import file_fingerprint
+from .jobqueue import FINAL_STATES, PRIORITIES
+from .helpers import logger, detect_url_type
+from .storage import StorageManager, estimate_footprint
+from .config import load_config, remember_vita_ip
+from .process import stage_context, pause_stage, resume_stage, StageTimeout, ProcessCancelled
+from .events import emit, job_scope, span, record_span, now
+
+class JobCancelled(Exception):
+    pass
+
+class JobHeld(Exception):
+    pass
+
+class Job:
+    def __init__(self, job_id, url, media_type, targets, on_update=None, options=None, priority='normal'):
+        self.id = job_id
+        self.url = url
+        self.media_type = media_type
+        self.targets = targets
+        self.on_update = on_update
+        self.options = options or {}  # target_size (bytes or 'card'), two_pass
+        self.priority = priority  # one of PRIORITIES; picks the job's lane in every stage
+        self.context = None  # stage_context() of the running stage, for pausing its process
+        self.state = 'queued'
+        self.stage = None
+        self.progress = ''
+        self.error = None
+        self.downloaded_file = None
+        self.converted_file = None
+        self.fingerprint = None  # local files only; the history uses it to skip repeat uploads
+        self.preflights = {}
+        self.uploads = {}  # "ip:port" -> {'sha256', 'bytes', 'verified', 'failures'}
+        self.attempts = {}  # stage -> timed-out attempts so far
+        self.queued_at = now()  # when the job last entered a stage pool's queue
+        self.temp_folder = None  # unique per download; job ids repeat across processes
+        self.cancel_event = threading.Event()
+        self.done = threading.Event()
+        self.done_callbacks = []
+        self.callbacks_lock = threading.Lock()
+
+    def update(self, **fields):
+        for key, value in fields.items():
+            setattr(self, key, value)
+        if self.on_update:
+            self.on_update(self, fields)
+        if 'state' in fields:
+            emit('job', job=self.id, state=self.state, stage=self.stage)
+        if fields.get('state') in FINAL_STATES:
+            with self.callbacks_lock:
+                self.done.set()
+                callbacks, self.done_callbacks = self.done_callbacks, []
+            for callback in callbacks:
+                self._call(callback)
+
+    def add_done_callback(self, callback):
+        # callback(job) runs once the job reaches a final state, right away if it already has
+        with self.callbacks_lock:
+            if not self.done.is_set():
+                self.done_callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            logger.error(f"Job {self.id} done callback failed: {e}")
+
+    def wait(self, timeout=None):
+        # Returns the final state, or None on timeout
+        return self.state if self.done.wait(timeout) else None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise JobCancelled(f"Job {self.id} cancelled")
+
+class StagePool:
+    """Worker threads for one stage with a queue per priority lane.
+
+    Free workers take the oldest job of the highest lane. A high-priority
+    job that finds every worker busy with lower lanes gets an extra worker
+    of its own, so it never waits behind batch work.
+    """
+
+    def __init__(self, stage, workers, run):
+        self.stage = stage
+        self.workers = workers
+        self.run = run  # run(job, stage)
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()  # FIFO within a lane
+        self.lock = threading.Lock()
+        self.running = set()
+        self.idle = 0
+        self.extras = set()  # lanes with an extra worker started but not yet holding a job
+        self.threads = [self._start(f"{stage}_{i}") for i in range(workers)]
+
+    def _start(self, name, lane=None):
+        # lane is set for an extra worker, which runs one job and exits
+        thread = threading.Thread(target=self._work, args=(lane,), name=name)
+        thread.start()
+        return thread
+
+    def put(self, job):
+        rank = PRIORITIES.index(job.priority)
+        with self.lock:
+            self.queue.put((rank, next(self.order), job))
+            # running only changes once a worker has dequeued, so a burst of
+            # puts must not start an extra each: one per lane is outstanding
+            if (rank == 0 and not self.idle and job.priority not in self.extras
+                    and all(other.priority != job.priority for other in self.running)):
+                self.extras.add(job.priority)
+                self.threads = [thread for thread in self.threads if thread.is_alive()]
+                self.threads.append(self._start(f"{self.stage}_extra", lane=job.priority))
+
+    def running_jobs(self):
+        with self.lock:
+            return list(self.running)
+
+    def _work(self, lane):
+        once = lane is not None
+        while True:
+            with self.lock:
+                self.idle += 1
+            item = self.queue.get()
+            job = item[2]
+            with self.lock:
+                self.idle -= 1
+                self.extras.discard(lane)
+                if job is not None:
+                    self.running.add(job)
+            if job is None:
+                if once:
+                    self.queue.put(item)  # the sentinel belongs to a regular worker
+                return
+            try:
+                self.run(job, self.stage)
+            except Exception as e:
+                logger.error(f"{self.stage} worker failed on job {job.id}: {e}")
+            finally:
+                with self.lock:
+                    self.running.discard(job)
+            if once:
+                return
+
+    def shutdown(self, wait=True):
+        # Sentinels rank below every lane, so queued jobs still run first
+        for _ in range(self.workers):
+            self.queue.put((len(PRIORITIES), next(self.order), None))
+        if wait:
+            with self.lock:
+                threads = list(self.threads)
+            for thread in threads:
+                thread.join()
+
+class Scheduler:
+    # Each stage has its own worker pool, so one job's upload overlaps the
+    # next job's encode and a third job's download. Within a pool, jobs are
+    # served by priority lane; a high-priority encode pauses lower-priority
+    # ones (SIGSTOP/SIGCONT, POSIX only) until it is done.
+    STAGES = ('download', 'convert', 'transfer')
+
+    def __init__(self, download_workers=2, convert_workers=1, transfer_workers=2, discover=True,
+                 storage=None, offline_action=None):
+        config = load_config(silent=True)
+        self.discover = discover
+        self.offline_action = offline_action or config.get('offline_action', 'hold')
+        self.storage = storage or StorageManager.from_config(config)
+        self.retries = config.get('stage_retries', 1)
+        self.pause_encodes = config.get('pause_encodes', True)
+        self.limits = {'download': download_workers, 'convert': convert_workers, 'transfer': transfer_workers}
+        self.pools = {stage: StagePool(stage, n, self._run_stage) for stage, n in self.limits.items()}
+        self.lock = threading.Lock()
+        self.in_download = 0
+        self.jobs = {}
+
+    def has_capacity(self):
+        # Admit new jobs only while the download stage has a free slot
+        # (high-priority jobs don't have to wait for one)
+        with self.lock:
+            return self.in_download < self.limits['download']
+
+    def submit(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+            self.in_download += 1
+        self._enqueue(job, 'download')
+
+    def _enqueue(self, job, stage):
+        job.queued_at = now()
+        emit('queue', stage=stage, change=1)
+        self.pools[stage].put(job)
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job:
+            job.cancel()
+        return job is not None
+
+    def shutdown(self, wait=True):
+        for stage in self.STAGES:
+            self.pools[stage].shutdown(wait=wait)
+
+    def _run_stage(self, job, stage):
+        # Time spent waiting for a free worker of this stage
+        record_span(f"queued for {stage}", 'queue', job.queued_at, job=job.id, job_label=job.url, stage=stage)
+        emit('queue', stage=stage, change=-1)
+        try:
+            job.check_cancelled()
+            job.update(state='running', stage=stage, progress='')
+            # Child processes of the stage share its deadline and die on cancel
+            with stage_context(stage, job.cancel_event) as job.context, job_scope(job.id, job.url), \
+                    span(stage, 'stage', priority=job.priority):
+                paused = self._preempt(job, stage)
+                try:
+                    getattr(self, f"_{stage}")(job)
+                finally:
+                    job.context = None
+                    for other, context in paused:
+                        logger.info(f"Job {other.id} encode resumed")
+                        resume_stage(context)
+                        other.update(progress='')
+        except (JobCancelled, ProcessCancelled):
+            logger.info(f"Job {job.id} cancelled during {stage}")
+            self._finish(job, 'cancelled')
+            return
+        except StageTimeout as e:
+            if self._requeue(job, stage, e):
+                return
+            logger.error(f"Job {job.id} timed out during {stage}: {e}")
+            log_to_history(job.url, job.media_type, "failed", str(e))
+            self._finish(job, 'failed', str(e))
+            return
+        except JobHeld as e:
+            logger.warning(f"Job {job.id} held during {stage}: {e}")
+            log_to_history(job.url, job.media_type, "held", str(e))
+            self._finish(job, 'held', str(e))
+            return
+        except Exception as e:
+            logger.error(f"Job {job.id} failed during {stage}: {e}")
+            log_to_history(job.url, job.media_type, "failed", str(e))
+            self._finish(job, 'failed', str(e))
+            return
+        finally:
+            if stage == 'download':
+                with self.lock:
+                    self.in_download -= 1
+        
+        next_index = self.STAGES.index(stage) + 1
+        if next_index < len(self.STAGES):
+            next_stage = self.STAGES[next_index]
+            job.update(state='waiting', stage=next_stage)
+            self._enqueue(job, next_stage)
+
+    def _preempt(self, job, stage):
+        # A high-priority encode gets the CPU: lower-priority encodes are
+        # stopped until it finishes. Returns the jobs it paused.
+        if stage != 'convert' or job.priority != PRIORITIES[0] or not self.pause_encodes:
+            return []
+        paused = []
+        for other in self.pools['convert'].running_jobs():
+            context = other.context
+            if other is job or other.priority == job.priority or context is None:
+                continue
+            if pause_stage(context):
+                logger.info(f"Job {other.id} encode paused for job {job.id}")
+                other.update(progress=f"Paused for job {job.id}")
+                paused.append((other, context))
+        return paused
+
+    def _requeue(self, job, stage, error):
+        # Put a timed-out stage back at the end of its pool's queue
+        attempts = job.attempts.get(stage, 0) + 1
+        if attempts > self.retries:
+            return False
+        job.attempts[stage] = attempts
+        logger.warning(f"Job {job.id} {stage} timed out ({error}), requeued ({attempts}/{self.retries})")
+        if stage == 'download':
+            # Start over from an empty temp folder and a fresh reservation
+            if job.temp_folder:
+                shutil.rmtree(job.temp_folder, ignore_errors=True)
+                job.temp_folder = None
+            self.storage.release(job.id)
+            with self.lock:
+                self.in_download += 1
+        job.update(state='waiting', progress=f"Timed out, retry {attempts}/{self.retries}")
+        self._enqueue(job, stage)
+        return True
+
+    def _download(self, job):
+        _, vita_path, _ = get_output_settings(job.media_type)
+        discover = self.discover and len(job.targets) == 1
+        job.preflights = {target: start_preflight(target[0], target[1], vita_path, discover)
+                          for target in job.targets}
+        
+        self._admit(job)
+        if os.path.isfile(job.url):
+            job.downloaded_file = job.url
+            job.fingerprint = file_fingerprint(job.url)
+        else:
+            os.makedirs(TEMP_FOLDER, exist_ok=True)
+            job.temp_folder = tempfile.mkdtemp(prefix=f"job-{job.id}-", dir=TEMP_FOLDER)
+            job.downloaded_file = download_media(job.url, job.media_type, job.temp_folder)
+        # The download is on disk now and counted by the folder usage
+        self.storage.release(job.id, 'temp')
+        self._check_targets(job)
+
+    def _check_targets(self, job):
+        # The preflights ran alongside the download; act on them before the encode
+        offline, free_space = [], []
+        for (ip, port), preflight in job.preflights.items():
+            status = preflight.result()
+            if not status['reachable']:
+                offline.append(f"{ip}:{port} ({status['error']})")
+                continue
+            if status.get('discovered'):
+                logger.info(f"PS Vita not found at {ip}, discovered it at {status['ip']}")
+                remember_vita_ip(status['ip'])
+            if status['free_bytes'] is not None:
+                free_space.append(status['free_bytes'])
+        if offline and self.offline_action == 'fail':
+            raise Exception(f"PS Vita not reachable at {', '.join(offline)}")
+        
+        if job.options.get('target_size') == 'card':
+            # Fit what is left on the memory card, with a small safety margin
+            job.options['target_size'] = int(min(free_space) * 0.95) if free_space else None
+            if not free_space:
+                logger.warning(f"Job {job.id}: free space on the PS Vita is unknown, converting at the default bitrate")
+
+    def _admit(self, job):
+        # Reserve temp and converted space before spending any bandwidth.
+        # The estimate comes from the extractor metadata that format
+        # selection fetches anyway (get_video_info() is memoized).
+        local_file = job.url if os.path.isfile(job.url) else None
+        info = None
+        if not local_file and detect_url_type(job.url) != 'mega':
+            info = get_video_info(job.url)
+        target_size = job.options.get('target_size')
+        temp, converted = estimate_footprint(job.media_type, info, local_file,
+                                             target_size if target_size != 'card' else None)
+        
+        if not self.storage.can_ever_fit(temp, converted):
+            raise JobHeld(f"Job needs more than the configured storage caps "
+                          f"(temp {temp / (1024*1024):.0f} MB, converted {converted / (1024*1024):.0f} MB)")
+        
+        waiting_since = None
+        while True:
+            job.check_cancelled()
+            in_use = {other.converted_file for other in list(self.jobs.values()) if other.converted_file}
+            if self.storage.reserve(job.id, temp, converted, in_use):
+                if waiting_since:
+                    record_span("waiting for disk space", 'queue', waiting_since)
+                return
+            # Wait only while another job can still free space
+            busy = self.storage.has_other_reservations(job.id) or any(
+                other is not job and other.stage in ('convert', 'transfer') for other in list(self.jobs.values()))
+            if not busy:
+                raise JobHeld("Not enough disk space")
+            job.update(progress='Waiting for disk space')
+            waiting_since = waiting_since or now()
+            self.storage.wait(5)
+
+    def _convert(self, job):
+        # Parallel encodes would interleave ffmpeg progress on the console
+        job.converted_file = convert_media(job.downloaded_file, job.media_type, job.fingerprint,
+                                           target_size=job.options.get('target_size'),
+                                           two_pass=job.options.get('two_pass', False),
+                                           quiet=self.limits['convert'] > 1)
+        self.storage.release(job.id, 'converted')
+
+    def _transfer(self, job):
+        online = []
+        size = os.path.getsize(job.converted_file)
+        for target, preflight in job.preflights.items():
+            status = preflight.result()
+            error = status['error']
+            if status['reachable'] and status['free_bytes'] is not None and status['free_bytes'] < size:
+                error = f"Not enough free space ({status['free_bytes'] / (1024*1024):.1f} MB free)"
+            if status['reachable'] and not error:
+                online.append((status['ip'], status['port']))
+            else:
+                log_to_history(job.url, job.media_type, "held", error, target=f"{target[0]}:{target[1]}",
+                               file=os.path.basename(job.converted_file), **self._source(job))
+        
+        if not online:
+            self._finish(job, 'held', "No PS Vita reachable")
+            return
+        
+        results = transfer_media(job.converted_file, online, job.media_type,
+                                 lambda message: job.update(progress=message))
+        failed = []
+        for (ip, port), (ok, error, upload) in results.items():
+            log_to_history(job.url, job.media_type, "completed" if ok else "failed", error,
+                           target=f"{ip}:{port}", file=os.path.basename(job.converted_file),
+                           **self._source(job), **(upload or {}))
+            if ok:
+                job.uploads[f"{ip}:{port}"] = upload
+            else:
+                failed.append(f"{ip}:{port}: {error}")
+        
+        if failed:
+            self._finish(job, 'failed', "; ".join(failed))
+        elif len(online) < len(job.targets):
+            self._finish(job, 'held', "Some PS Vitas were not reachable")
+        else:
+            self._finish(job, 'completed')
+
+    def _source(self, job):
+        # History fields identifying a local source file
+        return {'fingerprint': job.fingerprint} if job.fingerprint else {}
+
+    def _finish(self, job, state, error=None):
+        if job.temp_folder and os.path.isdir(job.temp_folder):
+            shutil.rmtree(job.temp_folder, ignore_errors=True)
+        self.storage.release(job.id)
+        job.update(state=state, stage=None, error=error)
+        with self.lock:
+            self.jobs.pop(job.id, None)
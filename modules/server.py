@@ -0,0 +1,256 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from .jobqueue import JobQueue, PRIORITIES
+from .scheduler import Scheduler, Job
+from .download import is_playlist_url, expand_playlist
+from .helpers import logger, parse_size
+from .ratelimit import get_limits, set_limits
+from .metrics import enable_metrics, Gauge, CONTENT_TYPE
+
+MAX_JOB_LIST = 1000  # rows per GET /jobs; SQLite reads a negative LIMIT as "all"
+
+class JobService:
+    def __init__(self, default_targets, resolve_targets, download_workers=2,
+                 convert_workers=1, transfer_workers=2, queue=None):
+        self.default_targets = default_targets
+        self.resolve_targets = resolve_targets
+        self.queue = queue or JobQueue()
+        self.scheduler = Scheduler(download_workers, convert_workers, transfer_workers)
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.metrics = enable_metrics()
+        self.metrics.register(Gauge('psvmp_service_jobs', 'Jobs in the job service database by state', ('state',)),
+                              self._collect_queue)
+
+    def _collect_queue(self, gauge):
+        counts = self.queue.count_by_state()
+        gauge.values = {(state,): counts.get(state, 0) for state in ('queued', 'running', 'waiting')}
+        gauge.values.update({(state,): count for state, count in counts.items()})
+
+    def targets_for(self, target):
+        # The 'ip' of a request: "IP[:PORT]", a comma-separated list or a device group
+        if target is None or target == '':
+            return self.default_targets
+        if not isinstance(target, str):
+            raise ValueError("'ip' must be a string")
+        try:
+            targets = self.resolve_targets(target)
+        except ValueError:
+            raise ValueError(f"Invalid PS Vita address: {target}") from None  # port isn't a number
+        if not targets:
+            raise ValueError("'ip' names no PS Vita")
+        for ip, port in targets:
+            if not ip or not 0 < port < 65536:
+                raise ValueError(f"Invalid PS Vita address: {ip}:{port}")
+        return targets
+
+    def submit(self, urls, media_type='video', targets=None, options=None, priority='normal'):
+        targets = targets or self.default_targets
+        job_ids = [self.queue.submit(url, media_type, targets, options, priority) for url in urls]
+        logger.info(f"Queued {len(job_ids)} job(s): {job_ids}")
+        self.wakeup.set()
+        return job_ids
+
+    def expand(self, urls):
+        # Each playlist/channel item becomes its own job
+        expanded = []
+        for url in urls:
+            if is_playlist_url(url):
+                _, entries = expand_playlist(url)
+                expanded.extend(entry['url'] for entry in entries)
+            else:
+                expanded.append(url)
+        return expanded
+
+    def cancel(self, job_id):
+        if self.queue.cancel(job_id):
+            return True
+        return self.scheduler.cancel(job_id)
+
+    def _on_job_update(self, job, fields):
+        self.queue.update(job.id, **fields)
+        if 'state' in fields:
+            # A download slot may have freed up
+            self.wakeup.set()
+
+    def dispatch_forever(self):
+        while not self.stopping:
+            while True:
+                # High-priority jobs start even when every download slot is taken
+                row = self.queue.claim_next(PRIORITIES if self.scheduler.has_capacity() else PRIORITIES[:1])
+                if row is None:
+                    break
+                job = Job(row['id'], row['url'], row['media_type'], row['targets'],
+                          self._on_job_update, row['options'], row['priority'])
+                self.scheduler.submit(job)
+            self.wakeup.wait(1)
+            self.wakeup.clear()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        self.scheduler.shutdown(wait=False)
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logger.info(f"HTTP {self.address_string()} {format % args}")
+
+        def _send(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_json(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if not length:
+                return {}
+            return json.loads(self.rfile.read(length).decode('utf-8'))
+
+        def _job_id(self, path):
+            parts = [p for p in path.split('/') if p]
+            if len(parts) >= 2 and parts[0] == 'jobs' and parts[1].isdigit():
+                return int(parts[1])
+            return None
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            if parsed.path.rstrip('/') == '/limits':
+                self._send(200, get_limits())
+                return
+            if parsed.path.rstrip('/') == '/metrics':
+                body = service.metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if parsed.path.rstrip('/') == '/jobs':
+                query = parse_qs(parsed.query)
+                state = query.get('state', [None])[0]
+                try:
+                    limit = int(query.get('limit', [100])[0])
+                except ValueError:
+                    self._send(400, {'error': "'limit' must be a number"})
+                    return
+                limit = max(1, min(limit, MAX_JOB_LIST))
+                self._send(200, {'jobs': service.queue.list(state, limit)})
+                return
+            
+            job_id = self._job_id(parsed.path)
+            job = service.queue.get(job_id) if job_id else None
+            if job:
+                self._send(200, job)
+            else:
+                self._send(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            parsed = urlparse(self.path)
+            if parsed.path.endswith('/cancel'):
+                self._cancel(self._job_id(parsed.path))
+                return
+            if parsed.path.rstrip('/') == '/limits':
+                self._update_limits()
+                return
+            if parsed.path.rstrip('/') != '/jobs':
+                self._send(404, {'error': 'Not found'})
+                return
+            
+            try:
+                data = self._read_json()
+            except (ValueError, UnicodeDecodeError):
+                self._send(400, {'error': 'Invalid JSON'})
+                return
+            if not isinstance(data, dict):
+                self._send(400, {'error': 'Expected a JSON object'})
+                return
+            
+            urls = data.get('urls') or ([data['url']] if data.get('url') else [])
+            media_type = data.get('type', 'video')
+            if not isinstance(urls, list) or not urls or not all(isinstance(url, str) and url.strip() for url in urls) \
+                    or media_type not in ('video', 'music'):
+                self._send(400, {'error': "Expected 'url' or 'urls' and 'type' of video/music"})
+                return
+            try:
+                targets = service.targets_for(data.get('ip'))
+            except ValueError as e:
+                self._send(400, {'error': str(e)})
+                return
+            priority = data.get('priority', 'normal')
+            if priority not in PRIORITIES:
+                self._send(400, {'error': f"'priority' must be one of {', '.join(PRIORITIES)}"})
+                return
+            
+            try:
+                urls = service.expand(urls)
+            except Exception as e:
+                self._send(502, {'error': f"Could not expand playlist: {e}"})
+                return
+            if not urls:
+                self._send(400, {'error': 'Playlist is empty'})
+                return
+            
+            # budget is shared by all URLs of the request; target_size is per job
+            try:
+                options = {'two_pass': bool(data.get('two_pass'))}
+                if data.get('budget'):
+                    options['target_size'] = parse_size(data['budget']) // len(urls)
+                elif data.get('target_size'):
+                    options['target_size'] = parse_size(data['target_size'])
+            except ValueError as e:
+                self._send(400, {'error': str(e)})
+                return
+            
+            job_ids = service.submit(urls, media_type, targets, options, priority)
+            self._send(201, {'jobs': job_ids})
+
+        def do_PUT(self):
+            if urlparse(self.path).path.rstrip('/') == '/limits':
+                self._update_limits()
+            else:
+                self._send(404, {'error': 'Not found'})
+
+        def _update_limits(self):
+            # e.g. {"upload_limit": "2M", "job_download_limit": null}; applies to running transfers
+            try:
+                data = self._read_json()
+                if not isinstance(data, dict):
+                    raise ValueError("expected a JSON object")
+                limits = set_limits(data)
+            except (ValueError, UnicodeDecodeError) as e:
+                self._send(400, {'error': f"Invalid limits: {e}"})
+                return
+            self._send(200, limits)
+
+        def do_DELETE(self):
+            self._cancel(self._job_id(urlparse(self.path).path))
+
+        def _cancel(self, job_id):
+            if job_id and service.cancel(job_id):
+                self._send(200, {'cancelled': job_id})
+            else:
+                self._send(404, {'error': 'Job not found or already finished'})
+    
+    return Handler
+
+def serve(service, host='127.0.0.1', port=8765):
+    httpd = ThreadingHTTPServer((host, port), make_handler(service))
+    dispatcher = threading.Thread(target=service.dispatch_forever, name='dispatcher', daemon=True)
+    dispatcher.start()
+    
+    logger.info(f"Job service listening on http://{host}:{port}")
+    print(f"Job service listening on http://{host}:{port}. Press Ctrl+C to stop.")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopping job service...")
+    finally:
+        httpd.server_close()
+        service.stop()
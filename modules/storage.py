@@ -0,0 +1,148 @@
+import os
+import shutil
+import threading
+
+from .constants import TEMP_FOLDER, CONVERTED_FOLDER
+from .helpers import logger, parse_size
+from .cache import evict_converted
+
+# Footprint estimates. yt-dlp keeps the separate video and audio streams
+# until it has merged them, so a download briefly needs about twice its size.
+MERGE_OVERHEAD = 2
+VIDEO_OUTPUT_RATE = (1500 + 128) * 1000 / 8 * 1.05  # bytes/s at the Vita bitrate, plus muxing
+MUSIC_OUTPUT_RATE = 320 * 1000 / 8
+UNKNOWN_VIDEO_DOWNLOAD = 1024 ** 3  # no size or duration from the extractor
+UNKNOWN_MUSIC_DOWNLOAD = 100 * 1024 ** 2
+
+def folder_usage(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def _existing_parent(path):
+    # disk_usage() needs a path that exists; the folders are created lazily
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+def estimate_footprint(media_type, info=None, local_file=None, target_size=None):
+    """Return (temp_bytes, converted_bytes) a job needs while it runs."""
+    if local_file:
+        # Nothing is downloaded; the output is at most about the input size
+        return 0, target_size or os.path.getsize(local_file)
+
+    info = info or {}
+    duration = info.get('duration')
+    if media_type == 'music':
+        if duration:
+            output = duration * MUSIC_OUTPUT_RATE
+            return int(output * MERGE_OVERHEAD), int(output)
+        return UNKNOWN_MUSIC_DOWNLOAD, UNKNOWN_MUSIC_DOWNLOAD // 2
+
+    download = None
+    formats = info.get('requested_formats') or ([info] if info else [])
+    sizes = [fmt.get('filesize') or fmt.get('filesize_approx') for fmt in formats]
+    if sizes and all(sizes):
+        download = sum(sizes)
+    elif info.get('tbr') and duration:
+        download = info['tbr'] * 1000 / 8 * duration
+
+    if target_size:
+        output = target_size
+    elif duration:
+        output = duration * VIDEO_OUTPUT_RATE
+    else:
+        output = (download or UNKNOWN_VIDEO_DOWNLOAD) / 2
+    return int((download or UNKNOWN_VIDEO_DOWNLOAD) * MERGE_OVERHEAD), int(output)
+
+class StorageManager:
+    """Reserves temp and converted space for jobs before they start.
+
+    A reservation counts against the folder caps and the free disk space
+    until the stage that writes it has finished; after that the files
+    themselves are on disk and counted by folder_usage().
+    """
+
+    KINDS = ('temp', 'converted')
+
+    def __init__(self, temp_cap=None, converted_cap=None, min_free=0):
+        self.caps = {'temp': temp_cap, 'converted': converted_cap}
+        self.folders = {'temp': TEMP_FOLDER, 'converted': CONVERTED_FOLDER}
+        self.min_free = min_free
+        self.reservations = {}
+        self.changed = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config):
+        def size(key):
+            value = config.get(key)
+            return parse_size(str(value)) if value not in (None, '') else None
+        return cls(size('temp_cap'), size('converted_cap'), size('min_free_space') or 0)
+
+    def _outstanding(self, kind):
+        return sum(reservation[kind] for reservation in self.reservations.values())
+
+    def _shortfall(self, needs):
+        # Bytes missing per folder cap, and on the disk itself
+        short = {}
+        for kind in self.KINDS:
+            cap = self.caps[kind]
+            if cap is not None and needs[kind]:
+                over = folder_usage(self.folders[kind]) + self._outstanding(kind) + needs[kind] - cap
+                if over > 0:
+                    short[kind] = over
+
+        free = shutil.disk_usage(_existing_parent(TEMP_FOLDER)).free - self.min_free
+        free -= sum(self._outstanding(kind) for kind in self.KINDS)
+        if sum(needs.values()) > free:
+            short['disk'] = sum(needs.values()) - free
+        return short
+
+    def can_ever_fit(self, temp, converted):
+        return ((self.caps['temp'] is None or temp <= self.caps['temp']) and
+                (self.caps['converted'] is None or converted <= self.caps['converted']))
+
+    def reserve(self, job_id, temp, converted, protected=()):
+        # protected: converted files still in use, never evicted
+        with self.changed:
+            needs = {'temp': temp, 'converted': converted}
+            short = self._shortfall(needs)
+            if short.get('converted') or short.get('disk'):
+                # Delivered cached conversions are the only files we may delete
+                evict_converted(max(short.get('converted', 0), short.get('disk', 0)), protected)
+                short = self._shortfall(needs)
+            if short:
+                logger.info(f"Not enough space for job {job_id} (temp {temp}, converted {converted}): "
+                            + ", ".join(f"{kind} short by {missing / (1024*1024):.0f} MB"
+                                        for kind, missing in short.items()))
+                return False
+            self.reservations[job_id] = needs
+            logger.info(f"Reserved space for job {job_id}: temp {temp}, converted {converted}")
+            return True
+
+    def release(self, job_id, kind=None):
+        # kind=None drops the whole reservation (job finished)
+        with self.changed:
+            reservation = self.reservations.get(job_id)
+            if reservation and kind:
+                reservation[kind] = 0
+            else:
+                self.reservations.pop(job_id, None)
+            self.changed.notify_all()
+
+    def has_other_reservations(self, job_id):
+        with self.changed:
+            return any(other != job_id and any(reservation.values())
+                       for other, reservation in self.reservations.items())
+
+    def wait(self, timeout=5):
+        with self.changed:
+            self.changed.wait(timeout)
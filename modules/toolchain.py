@@ -0,0 +1,183 @@
+import os
+import json
+import shutil
+import subprocess
+import threading
+
+from .constants import PSVMP_DIR
+from .helpers import logger
+
+TOOLCHAIN_CACHE_FILE = os.path.join(PSVMP_DIR, "toolchain.json")
+
+# Tool name -> executables to try, in order
+TOOLS = {
+    'ffmpeg': ['ffmpeg'],
+    'ffprobe': ['ffprobe'],
+    'yt-dlp': ['yt-dlp'],
+    'megatools': ['megatools-dl', 'megatools'],
+}
+
+VERSION_ARGS = {
+    'ffmpeg': ['-version'],
+    'ffprobe': ['-version'],
+    'yt-dlp': ['--version'],
+    'megatools': ['--version'],
+}
+
+# H.264 encoders that can produce Vita-compatible baseline streams, fastest first
+VIDEO_ENCODERS = ['h264_nvenc', 'h264_qsv', 'h264_videotoolbox', 'libx264']
+# Listed by every stock ffmpeg build, but they only work with the GPU and driver present
+HARDWARE_ENCODERS = ['h264_nvenc', 'h264_qsv', 'h264_videotoolbox']
+INTERESTING_ENCODERS = set(VIDEO_ENCODERS) | {'aac', 'libmp3lame'}
+INTERESTING_MUXERS = {'mp4', 'mp3', 'null'}
+
+REQUIRED = {
+    'video': {'tools': ['ffmpeg', 'ffprobe'], 'encoders': ['aac'], 'muxers': ['mp4']},
+    'music': {'tools': ['ffmpeg', 'ffprobe'], 'encoders': ['libmp3lame'], 'muxers': ['mp3']},
+}
+
+_toolchain = None
+_lock = threading.Lock()
+
+def _locate_tools():
+    paths = {}
+    for tool, candidates in TOOLS.items():
+        for candidate in candidates:
+            path = shutil.which(candidate)
+            if path:
+                paths[tool] = path
+                break
+    return paths
+
+def _run(cmd):
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=15,
+                                encoding='utf-8', errors='replace')
+        return result.stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Could not run {' '.join(cmd)}: {e}")
+        return ''
+
+def _parse_codec_list(output, wanted):
+    # Lines look like " V....D libx264   libx264 H.264 ..." / "  E mp4   MP4 ..."
+    found = []
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[1] in wanted:
+            found.append(parts[1])
+    return sorted(set(found))
+
+def _encoder_works(ffmpeg, encoder):
+    # A few frames of a generated picture, encoded the way conversions do
+    from .conversion import video_encoder_args
+    cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=320x240:rate=30',
+           '-frames:v', '5', *video_encoder_args(encoder), '-pix_fmt', 'yuv420p', '-f', 'null', '-']
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=15,
+                                encoding='utf-8', errors='replace')
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Could not test encoder {encoder}: {e}")
+        return False
+    if result.returncode != 0:
+        logger.info(f"Encoder {encoder} is listed but does not work: {result.stderr.strip()[-200:]}")
+    return result.returncode == 0
+
+def probe_toolchain():
+    paths = _locate_tools()
+    toolchain = {
+        'path_env': os.environ.get('PATH', ''),
+        'tools': {},
+        'missing': sorted(set(TOOLS) - set(paths)),  # trusted until PATH changes
+        'encoders': [],
+        'working_encoders': [],  # listed encoders that passed a test encode
+        'muxers': [],
+    }
+    
+    for tool, path in paths.items():
+        first_line = _run([path, *VERSION_ARGS[tool]]).strip().splitlines()[:1]
+        toolchain['tools'][tool] = {
+            'path': path,
+            'mtime': os.path.getmtime(path),
+            'version': first_line[0] if first_line else 'unknown',
+        }
+    
+    if 'ffmpeg' in paths:
+        toolchain['encoders'] = _parse_codec_list(_run([paths['ffmpeg'], '-hide_banner', '-encoders']), INTERESTING_ENCODERS)
+        toolchain['muxers'] = _parse_codec_list(_run([paths['ffmpeg'], '-hide_banner', '-muxers']), INTERESTING_MUXERS)
+        toolchain['working_encoders'] = [e for e in toolchain['encoders']
+                                         if e not in HARDWARE_ENCODERS or _encoder_works(paths['ffmpeg'], e)]
+    
+    versions = [f"{tool} ({info['version']})" for tool, info in toolchain['tools'].items()]
+    logger.info(f"Probed toolchain: {', '.join(versions)}; encoders: {', '.join(toolchain['encoders'])}")
+    return toolchain
+
+def _is_current(toolchain):
+    # Valid while PATH is unchanged and every cached binary is untouched.
+    # A tool installed into a PATH folder later is found by --check-deps,
+    # which always re-probes.
+    if toolchain.get('path_env') != os.environ.get('PATH', ''):
+        return False
+    if 'working_encoders' not in toolchain or 'missing' not in toolchain:
+        return False  # written by an older version
+    if set(toolchain['tools']) | set(toolchain['missing']) != set(TOOLS):
+        return False
+    for info in toolchain['tools'].values():
+        try:
+            if os.path.getmtime(info['path']) != info['mtime']:
+                return False
+        except OSError:
+            return False
+    return True
+
+def get_toolchain(refresh=False):
+    global _toolchain
+    
+    with _lock:
+        if _toolchain is not None and not refresh:
+            return _toolchain
+        
+        if not refresh:
+            try:
+                with open(TOOLCHAIN_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    cached = json.load(f)
+                if _is_current(cached):
+                    _toolchain = cached
+                    return _toolchain
+            except (OSError, ValueError):
+                pass
+        
+        _toolchain = probe_toolchain()
+        try:
+            os.makedirs(PSVMP_DIR, exist_ok=True)
+            with open(TOOLCHAIN_CACHE_FILE, 'w', encoding='utf-8') as f:
+                json.dump(_toolchain, f, indent=2)
+        except OSError as e:
+            logger.warning(f"Could not save toolchain cache: {e}")
+        return _toolchain
+
+def tool_path(tool):
+    info = get_toolchain()['tools'].get(tool)
+    return info['path'] if info else None
+
+def pick_video_encoder(preference='libx264'):
+    # "auto" picks the fastest working encoder; a named encoder is used if it works
+    available = get_toolchain()['working_encoders']
+    if preference != 'auto':
+        return preference if preference in available or not available else 'libx264'
+    for encoder in VIDEO_ENCODERS:
+        if encoder in available:
+            return encoder
+    return 'libx264'
+
+def missing_capabilities(media_types=('video', 'music'), video_encoder='libx264'):
+    toolchain = get_toolchain()
+    missing = []
+    for media_type in media_types:
+        required = REQUIRED[media_type]
+        encoders = required['encoders'] + ([pick_video_encoder(video_encoder)] if media_type == 'video' else [])
+        missing += [tool for tool in required['tools'] if tool not in toolchain['tools']]
+        # Encoder/muxer lists are only meaningful if ffmpeg itself was found
+        if 'ffmpeg' in toolchain['tools']:
+            missing += [f"ffmpeg encoder {e}" for e in encoders if e not in toolchain['encoders']]
+            missing += [f"ffmpeg muxer {m}" for m in required['muxers'] if m not in toolchain['muxers']]
+    return sorted(set(missing), key=missing.index)
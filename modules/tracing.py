@@ -0,0 +1,140 @@
+import io
+import os
+import sys
+import json
+import pstats
+import cProfile
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+from . import events
+from .constants import LOG_FOLDER
+from .helpers import logger
+
+PROFILE_FOLDER = os.path.join(LOG_FOLDER, "profiles")
+JOBS_PID, THREADS_PID = 1, 2
+
+class TraceRecorder:
+    """Records spans as Chrome trace events (chrome://tracing, ui.perfetto.dev).
+
+    Every job gets its own lane, so the queue waits between its stages show
+    up as gaps between the stage spans. Work outside a job (the single-URL
+    CLI run, preflights) goes in one lane per thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.origin = events.now()
+        self.events = []
+        self.lanes = {}
+        self.lock = threading.Lock()
+
+    def _lane(self, fields):
+        if fields.get('job') is not None:
+            key = (JOBS_PID, fields['job'])
+            label = f"job {fields['job']}: {fields.get('job_label') or ''}".rstrip(': ')
+        else:
+            key = (THREADS_PID, fields['thread'])
+            label = fields['thread']
+        if key not in self.lanes:
+            # Chrome wants integer thread ids; the names go in metadata events
+            self.lanes[key] = (len(self.lanes) + 1, label)
+        return key[0], self.lanes[key][0]
+
+    def __call__(self, kind, fields):
+        if kind != 'span':
+            return
+        with self.lock:
+            pid, tid = self._lane(fields)
+            self.events.append({
+                'name': fields['name'],
+                'cat': fields['category'],
+                'ph': 'X',
+                'ts': round((fields['start'] - self.origin) * 1e6, 1),
+                'dur': round((fields['end'] - fields['start']) * 1e6, 1),
+                'pid': pid,
+                'tid': tid,
+                'args': fields.get('args') or {},
+            })
+
+    def start(self):
+        events.subscribe(self)
+        return self
+
+    def stop(self):
+        events.unsubscribe(self)
+        with self.lock:
+            metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}}
+                        for pid, name in ((JOBS_PID, 'Jobs'), (THREADS_PID, 'Threads'))]
+            metadata += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': label}}
+                         for (pid, _), (tid, label) in self.lanes.items()]
+            trace = {'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f)
+        logger.info(f"Trace with {len(self.events)} spans written to {self.path}")
+        print(f"Trace written to {self.path} (open it in chrome://tracing or ui.perfetto.dev)", file=sys.stderr)
+
+class Profiler:
+    """cProfile for the main thread and every thread started while it runs
+    (the stage worker pools). Python 3.12+ profiles all threads from one
+    profiler, where a second one can't be enabled."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(PROFILE_FOLDER, f"psvmp-{datetime.now():%Y%m%d-%H%M%S}.prof")
+        self.profilers = []
+        self.lock = threading.Lock()
+
+    def _enable(self):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return
+        with self.lock:
+            self.profilers.append(profiler)
+
+    def _thread_started(self, frame, event, arg):
+        # Installed by threading.setprofile(); runs once in each new thread
+        sys.setprofile(None)
+        self._enable()
+
+    def start(self):
+        self._enable()
+        threading.setprofile(self._thread_started)
+        return self
+
+    def stop(self, top=20):
+        threading.setprofile(None)
+        with self.lock:
+            profilers, self.profilers = self.profilers, []
+        for profiler in profilers:
+            profiler.disable()
+        if not profilers:
+            return
+
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        stats.dump_stats(self.path)
+        logger.info(f"Profile of {len(profilers)} thread(s) written to {self.path}")
+
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats('cumulative').print_stats(top)
+        print(summary.getvalue(), file=sys.stderr)
+        print(f"Profile written to {self.path} (python -m pstats {self.path})", file=sys.stderr)
+
+@contextmanager
+def instrument(trace_file=None, profile=False):
+    # --trace / --profile for one CLI run; results are written however the run ends
+    recorder = TraceRecorder(trace_file).start() if trace_file else None
+    profiler = Profiler().start() if profile else None
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.stop()
+        if recorder:
+            recorder.stop()
@@ -1,11 +1,138 @@
 import os
+import errno
 import ftplib
+import random
+import socket
 import time
 import sys
-from tqdm import tqdm
+import queue
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from .helpers import logger
+from .ratelimit import get_pool
+from .events import traced, emit
+from .discovery import discover_vitas
 from .constants import MAX_RETRIES, RETRY_DELAY
 
+class UploadMismatch(Exception):
+    pass
+
+class TransferFailed(Exception):
+    # details ({'reason', 'failures'}) go in the history record
+    def __init__(self, message, reason, failures):
+        super().__init__(message)
+        self.details = {'reason': reason, 'failures': failures}
+
+RETRY_DELAY_CAP = 60  # seconds; the backoff doubles from RETRY_DELAY up to this
+
+# errno values, by name so platforms without one simply skip it. Windows
+# socket errors carry WSA codes (10060, 10061, ...) in errno.
+_TRANSIENT_ERRNOS = {
+    'timeout': ('ETIMEDOUT', 'WSAETIMEDOUT'),
+    'refused': ('ECONNREFUSED', 'WSAECONNREFUSED'),
+    'reset': ('ECONNRESET', 'ECONNABORTED', 'EPIPE', 'WSAECONNRESET', 'WSAECONNABORTED'),
+    'unreachable': ('EHOSTUNREACH', 'ENETUNREACH', 'EHOSTDOWN', 'ENETDOWN', 'ENETRESET',
+                    'WSAEHOSTUNREACH', 'WSAENETUNREACH', 'WSAEHOSTDOWN', 'WSAENETDOWN'),
+}
+_PERMANENT_ERRNOS = {
+    'disk_full': ('ENOSPC', 'EDQUOT'),
+    'permission': ('EACCES', 'EPERM', 'EROFS'),
+    'local_file': ('ENOENT', 'EISDIR'),
+}
+
+def _errno_table(names_by_reason):
+    return {getattr(errno, name): reason for reason, names in names_by_reason.items()
+            for name in names if hasattr(errno, name)}
+
+TRANSIENT_ERRNOS = _errno_table(_TRANSIENT_ERRNOS)
+PERMANENT_ERRNOS = _errno_table(_PERMANENT_ERRNOS)
+
+# FTP replies that say something more specific than their 4xx/5xx class
+FTP_REPLY_REASONS = {
+    '421': (True, 'server_busy'),
+    '425': (True, 'data_connection'),
+    '426': (True, 'reset'),
+    '450': (True, 'server_busy'),
+    '452': (False, 'disk_full'),  # 4xx, but waiting won't free space on the Vita
+    '530': (False, 'login'),
+    '550': (False, 'permission'),
+    '552': (False, 'disk_full'),
+    '553': (False, 'permission'),
+}
+
+# Replies a server gives to a REST it doesn't support or won't honour
+REST_REJECTED = ('500', '501', '502', '504', '550', '554')
+
+RETRY_MESSAGES = {
+    'timeout': "Connection timeout - Vita not responding",
+    'refused': "Connection refused - FTP server not running",
+    'unreachable': "Vita unreachable - check the Wi-Fi connection",
+    'reset': "Connection dropped",
+    'server_busy': "FTP server busy",
+    'disk_full': "Not enough space on the Vita",
+    'permission': "Permission denied",
+    'login': "Login rejected",
+}
+
+def classify_ftp_error(e):
+    """(transient, reason) for an exception from an FTP attempt.
+
+    Network trouble and 4xx replies are transient and worth a retry; 5xx
+    replies and local file errors are permanent, so a retry would only
+    fail the same way.
+    """
+    if isinstance(e, UploadMismatch):
+        return True, 'incomplete'
+    if isinstance(e, (ftplib.error_temp, ftplib.error_perm)):
+        code = str(e)[:3]
+        if code in FTP_REPLY_REASONS:
+            return FTP_REPLY_REASONS[code]
+        return isinstance(e, ftplib.error_temp), f"ftp_{code}" if code.isdigit() else 'ftp_error'
+    if isinstance(e, (ftplib.error_reply, ftplib.error_proto, EOFError)):
+        return True, 'protocol'
+    if isinstance(e, socket.timeout):
+        return True, 'timeout'
+    if isinstance(e, OSError):
+        if e.errno in TRANSIENT_ERRNOS:
+            return True, TRANSIENT_ERRNOS[e.errno]
+        if e.errno in PERMANENT_ERRNOS:
+            return False, PERMANENT_ERRNOS[e.errno]
+        if isinstance(e, ConnectionError):
+            return True, 'reset'
+        return True, 'network'
+    return False, 'error'
+
+def retry_delay(attempt):
+    # Exponential backoff with jitter, so devices that dropped off together
+    # (a Wi-Fi blip) don't all reconnect in the same second
+    delay = min(RETRY_DELAY_CAP, RETRY_DELAY * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+class _UploadHasher:
+    # sha256 of the bytes actually sent, fed from storbinary()'s callback so
+    # the file is never read a second time. A resumed upload resends from
+    # the REST offset; bytes that were already hashed are skipped.
+    def __init__(self):
+        self.sha = hashlib.sha256()
+        self.offset = 0
+
+    def update(self, position, data):
+        end = position + len(data)
+        if position <= self.offset < end:
+            self.sha.update(data[self.offset - position:])
+            self.offset = end
+
+    def hexdigest(self, size):
+        # Only meaningful once every byte of the file has gone through
+        return self.sha.hexdigest() if self.offset == size else None
+
+def remote_size(ftp, filename):
+    # SIZE is optional; None means the upload can't be checked
+    try:
+        return ftp.size(filename)
+    except (ftplib.error_perm, ftplib.error_reply, ValueError):
+        return None
+
 class VitaFTP:
     def __init__(self, ip, port):
         self.ip = ip
@@ -13,12 +140,112 @@ class VitaFTP:
         self.timeout = 10
         logger.info(f"Initialized FTP connection to {ip}:{port}")
 
-    def transfer(self, local_path, remote_path, progress_callback=None):
+    def preflight(self, remote_dir):
+        # Single connection attempt, no retries: we only want to know if the
+        # Vita is there before spending time on the encode.
+        status = {
+            'ip': self.ip,
+            'port': self.port,
+            'reachable': False,
+            'rtt_ms': None,
+            'dir_exists': False,
+            'free_bytes': None,
+            'error': None
+        }
+        
+        try:
+            with ftplib.FTP(timeout=self.timeout) as ftp:
+                ftp.connect(self.ip, self.port)
+                status['reachable'] = True
+                
+                start = time.monotonic()
+                ftp.voidcmd('NOOP')
+                status['rtt_ms'] = round((time.monotonic() - start) * 1000, 1)
+                
+                try:
+                    drive, _, rest = remote_dir.partition(':')
+                    ftp.cwd(f"{drive}:")
+                    for part in [p for p in rest.split('/') if p]:
+                        ftp.cwd(part)
+                    status['dir_exists'] = True
+                except ftplib.error_perm:
+                    pass
+                
+                # AVBL is optional; servers without it reply 5xx
+                try:
+                    reply = ftp.sendcmd(f"AVBL {remote_dir}")
+                    status['free_bytes'] = int(reply.split()[-1])
+                except (ftplib.error_perm, ValueError, IndexError):
+                    pass
+        except Exception as e:
+            status['error'] = str(e)
+        
+        if status['reachable']:
+            logger.info(f"Preflight OK: {self.ip}:{self.port} rtt={status['rtt_ms']}ms "
+                        f"dir_exists={status['dir_exists']} free={status['free_bytes']}")
+        else:
+            logger.warning(f"Preflight failed: {self.ip}:{self.port} - {status['error']}")
+        return status
+
+    def _enter_remote_dir(self, ftp, remote_path, progress_callback=None):
+        if '/music/' in remote_path:
+            # Music path
+            try:
+                ftp.cwd('ux0:')
+                ftp.cwd('music')
+            except ftplib.error_perm:
+                if progress_callback:
+                    progress_callback("Music directory not found, creating it...")
+                    sys.stdout.flush()
+                try:
+                    ftp.cwd('ux0:')
+                    ftp.mkd('music')
+                    ftp.cwd('music')
+                except ftplib.error_perm as e:
+                    if progress_callback:
+                        progress_callback(f"Directory creation error: {str(e)}")
+                        sys.stdout.flush()
+                    pass
+        else:
+            # Video path
+            try:
+                ftp.cwd('ux0:')
+                ftp.cwd('video')
+                ftp.cwd('shows')
+            except ftplib.error_perm:
+                if progress_callback:
+                    progress_callback("Shows directory not found, creating it...")
+                    sys.stdout.flush()
+                try:
+                    ftp.cwd('ux0:')
+                    ftp.cwd('video')
+                    ftp.mkd('shows')
+                    ftp.cwd('shows')
+                except ftplib.error_perm as e:
+                    if progress_callback:
+                        progress_callback(f"Directory creation error: {str(e)}")
+                        sys.stdout.flush()
+                    pass
+
+    @traced('upload', 'transfer')
+    def transfer(self, local_path, remote_path, progress_callback=None, verify=True, resume=False):
+        # Returns {'sha256', 'bytes', 'verified', 'failures'} for the history,
+        # failures counting failed attempts by reason. With verify, the remote
+        # SIZE is compared after STOR and a short file is resumed with REST
+        # on the next attempt. resume=True also resumes a partial file left
+        # by an earlier upload of this same file. Raises TransferFailed.
+        from tqdm import tqdm
+        
         file_size = os.path.getsize(local_path)
         filename = os.path.basename(local_path)
+        remote_filename = os.path.basename(remote_path)
+        hasher = _UploadHasher()
+        resume_failed = False
+        failures = {}
         logger.info(f"Starting FTP transfer: {filename} ({file_size} bytes)")
         
         for attempt in range(1, MAX_RETRIES + 1):
+            resume_from = position = 0
             try:
                 if progress_callback:
                     progress_callback(f"Attempt {attempt}/{MAX_RETRIES}: Connecting to {self.ip}:{self.port}...")
@@ -27,88 +254,226 @@ class VitaFTP:
                 with ftplib.FTP(timeout=self.timeout) as ftp:
                     ftp.connect(self.ip, self.port)
                     
-                    if '/music/' in remote_path:
-                        # Music path
-                        try:
-                            ftp.cwd('ux0:')
-                            ftp.cwd('music')
-                        except ftplib.error_perm:
-                            if progress_callback:
-                                progress_callback("Music directory not found, creating it...")
-                                sys.stdout.flush()
-                            try:
-                                ftp.cwd('ux0:')
-                                ftp.mkd('music')
-                                ftp.cwd('music')
-                            except ftplib.error_perm as e:
-                                if progress_callback:
-                                    progress_callback(f"Directory creation error: {str(e)}")
-                                    sys.stdout.flush()
-                                pass
-                    else:
-                        # Video path
-                        try:
-                            ftp.cwd('ux0:')
-                            ftp.cwd('video')
-                            ftp.cwd('shows')
-                        except ftplib.error_perm:
-                            if progress_callback:
-                                progress_callback("Shows directory not found, creating it...")
-                                sys.stdout.flush()
-                            try:
-                                ftp.cwd('ux0:')
-                                ftp.cwd('video')
-                                ftp.mkd('shows')
-                                ftp.cwd('shows')
-                            except ftplib.error_perm as e:
-                                if progress_callback:
-                                    progress_callback(f"Directory creation error: {str(e)}")
-                                    sys.stdout.flush()
-                                pass
+                    self._enter_remote_dir(ftp, remote_path, progress_callback)
+                    
+                    if verify and (resume or hasher.offset) and not resume_failed:
+                        ftp.voidcmd('TYPE I')
+                        partial = remote_size(ftp, remote_filename)
+                        if partial and partial < file_size:
+                            resume_from = partial
                     
                     if progress_callback:
-                        progress_callback(f"Connected! Transferring {filename}...")
+                        if resume_from:
+                            progress_callback(f"Connected! Resuming {filename} at {resume_from} bytes...")
+                        else:
+                            progress_callback(f"Connected! Transferring {filename}...")
                         sys.stdout.flush()
                     
-                    with open(local_path, 'rb') as f:
-                        with tqdm(total=file_size, unit='B', unit_scale=True, 
+                    with open(local_path, 'rb') as f, get_pool('upload').flow(filename) as flow:
+                        f.seek(resume_from)
+                        position = resume_from
+                        with tqdm(total=file_size, initial=resume_from, unit='B', unit_scale=True, 
                                  desc="Transfer Progress", leave=False) as pbar:
                             def callback(data):
+                                nonlocal position
+                                hasher.update(position, data)
+                                position += len(data)
                                 pbar.update(len(data))
+                                flow.consume(len(data))  # upload limit, shared fairly
                             
-                            remote_filename = os.path.basename(remote_path)
-                            ftp.storbinary(f"STOR {remote_filename}", f, callback=callback)
+                            ftp.storbinary(f"STOR {remote_filename}", f, callback=callback,
+                                           rest=resume_from or None)
                             print()  # Add newline after progress bar
                     
-                    logger.info(f"FTP transfer completed: {filename}")
+                    landed = remote_size(ftp, remote_filename) if verify else None
+                    if landed is not None and landed != file_size:
+                        raise UploadMismatch(f"Remote size {landed} does not match local size {file_size}")
+                    
+                    logger.info(f"FTP transfer completed: {filename}"
+                                + (" (size verified)" if landed is not None else ""))
                     if progress_callback:
                         progress_callback("Transfer completed successfully")
                         sys.stdout.flush()
-                    return True
+                    return {'sha256': hasher.hexdigest(file_size), 'bytes': file_size,
+                            'verified': landed is not None, 'failures': failures}
                     
             except Exception as e:
                 error_msg = str(e)
-                logger.warning(f"FTP transfer attempt {attempt} failed: {error_msg}")
+                transient, reason = classify_ftp_error(e)
+                # A server that rejects REST (an error reply before any data
+                # moved) or mangles the resumed file gets a full upload next time
+                if resume_from and (isinstance(e, UploadMismatch) or (
+                        isinstance(e, ftplib.error_perm) and str(e)[:3] in REST_REJECTED
+                        and position == resume_from)):
+                    resume_failed = True
+                    transient, reason = True, 'resume_rejected'
+                failures[reason] = failures.get(reason, 0) + 1
+                logger.warning(f"FTP transfer attempt {attempt} failed ({reason}): {error_msg}")
                 
                 if progress_callback:
-                    # Show specific error message
-                    if "10060" in error_msg or "timeout" in error_msg.lower():
-                        progress_callback(f"[!] Connection timeout - Vita not responding")
-                    elif "10061" in error_msg:
-                        progress_callback(f"[!] Connection refused - FTP server not running")
+                    if isinstance(e, UploadMismatch):
+                        progress_callback(f"[!] Upload incomplete - {error_msg}")
+                    elif reason in RETRY_MESSAGES:
+                        progress_callback(f"[!] {RETRY_MESSAGES[reason]} ({error_msg})")
                     else:
                         progress_callback(f"[!] Connection failed: {error_msg}")
                     sys.stdout.flush()
                 
+                if not transient:
+                    logger.error(f"FTP transfer failed, not retrying ({reason}): {error_msg}")
+                    if progress_callback:
+                        progress_callback(f"[!] Not retrying: {error_msg}")
+                        sys.stdout.flush()
+                    raise TransferFailed(error_msg, reason, failures)
                 if attempt < MAX_RETRIES:
+                    emit('ftp_retry', target=f"{self.ip}:{self.port}", reason=reason, error=error_msg)
+                    delay = retry_delay(attempt)
                     if progress_callback:
-                        progress_callback(f"[*] Retrying in {RETRY_DELAY}s... (Attempt {attempt + 1}/{MAX_RETRIES})")
+                        progress_callback(f"[*] Retrying in {delay:.1f}s... (Attempt {attempt + 1}/{MAX_RETRIES})")
                         sys.stdout.flush()
-                    time.sleep(RETRY_DELAY)
+                    time.sleep(delay)
                 else:
                     logger.error(f"FTP transfer failed after {MAX_RETRIES} attempts: {error_msg}")
                     if progress_callback:
                         progress_callback(f"[!] Failed after {MAX_RETRIES} attempts: {error_msg}")
                         sys.stdout.flush()
-                    raise Exception(f"Failed after {MAX_RETRIES} attempts: {error_msg}")
-        return False
\ No newline at end of file
+                    raise TransferFailed(f"Failed after {MAX_RETRIES} attempts: {error_msg}", reason, failures)
+        return None
+
+def _count_failure(failures, reason):
+    # failures plus one more attempt that failed for reason
+    return {**failures, reason: failures.get(reason, 0) + 1}
+
+class _FanoutStream:
+    # File-like object handed to storbinary(), fed by fanout_transfer()'s reader
+    def __init__(self, maxsize=32):
+        self.queue = queue.Queue(maxsize)
+        self.alive = True
+
+    def read(self, size=-1):
+        # b'' ends the upload; an exception means the reader could not finish
+        chunk = self.queue.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+@traced('upload (fan-out)', 'transfer')
+def fanout_transfer(local_path, remote_path, targets, progress_callback=None, blocksize=64*1024, verify=True):
+    # Uploads one file to several Vitas at once. The file is read a single time
+    # and each chunk is queued to every connection; the bounded queues keep
+    # memory flat, so the slowest Vita paces the others. A device that drops
+    # out of the shared stream falls back to its own VitaFTP.transfer().
+    from tqdm import tqdm
+    
+    filename = os.path.basename(local_path)
+    file_size = os.path.getsize(local_path)
+    remote_filename = os.path.basename(remote_path)
+    streams = {target: _FanoutStream() for target in targets}
+    sha = hashlib.sha256()  # fed by the single reader, shared by every target
+    logger.info(f"Starting fan-out transfer: {filename} ({file_size} bytes) to {len(targets)} devices")
+    
+    def notify(target, message):
+        if progress_callback:
+            progress_callback(f"[{target[0]}:{target[1]}] {message}")
+            sys.stdout.flush()
+    
+    def distribute(chunk):
+        for stream in streams.values():
+            while stream.alive:
+                try:
+                    stream.queue.put(chunk, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+    
+    def read_and_distribute():
+        # Every live stream gets an end marker, even if the read fails;
+        # otherwise its send() would block in storbinary() forever
+        end = OSError(f"Fan-out reader for {filename} stopped early")
+        try:
+            # One flow for the whole fan-out; every live device costs bandwidth
+            with open(local_path, 'rb') as f, get_pool('upload').flow(filename) as flow:
+                with tqdm(total=file_size, unit='B', unit_scale=True,
+                          desc="Transfer Progress", leave=False) as pbar:
+                    while True:
+                        chunk = f.read(blocksize)
+                        if not chunk:
+                            break
+                        flow.consume(len(chunk) * sum(stream.alive for stream in streams.values()))
+                        distribute(chunk)
+                        sha.update(chunk)
+                        pbar.update(len(chunk))
+            end = b''
+            print()  # Add newline after progress bar
+        except Exception as e:
+            logger.error(f"Fan-out read of {filename} failed: {e}")
+            end = e
+        finally:
+            distribute(end)
+    
+    def send(target):
+        ip, port = target
+        vita = VitaFTP(ip, port)
+        try:
+            with ftplib.FTP(timeout=vita.timeout) as ftp:
+                ftp.connect(ip, port)
+                vita._enter_remote_dir(ftp, remote_path)
+                notify(target, f"Connected! Transferring {filename}...")
+                ftp.storbinary(f"STOR {remote_filename}", streams[target])
+                landed = remote_size(ftp, remote_filename) if verify else None
+                if landed is not None and landed != file_size:
+                    raise UploadMismatch(f"Remote size {landed} does not match local size {file_size}")
+            logger.info(f"FTP transfer completed: {filename} -> {ip}:{port}")
+            notify(target, "Transfer completed successfully")
+            return True, None, {'verified': landed is not None, 'failures': {}}
+        except Exception as e:
+            streams[target].alive = False
+            transient, reason = classify_ftp_error(e)
+            logger.warning(f"Shared transfer to {ip}:{port} failed ({reason}): {e}")
+            shared_failure = reason
+            if not transient:
+                notify(target, f"[!] Shared transfer failed, not retrying: {e}")
+                return False, str(e), {'reason': reason, 'failures': {reason: 1}}
+            notify(target, f"[!] Shared transfer failed ({e}), retrying on its own")
+        
+        try:
+            # Picks up from whatever part of the file the shared stream delivered
+            upload = vita.transfer(local_path, remote_path, lambda message: notify(target, message),
+                                   verify=verify, resume=True)
+            return True, None, {'verified': upload['verified'],
+                                'failures': _count_failure(upload['failures'], shared_failure)}
+        except Exception as e:
+            details = getattr(e, 'details', None) or {'reason': classify_ftp_error(e)[1], 'failures': {}}
+            return False, str(e), {**details, 'failures': _count_failure(details['failures'], shared_failure)}
+    
+    with ThreadPoolExecutor(max_workers=len(targets) + 1) as executor:
+        reader = executor.submit(read_and_distribute)
+        futures = {target: executor.submit(send, target) for target in targets}
+        results = {target: future.result() for target, future in futures.items()}
+        reader.result()
+    
+    digest = sha.hexdigest()
+    return {target: (ok, error, {'sha256': digest, 'bytes': file_size, **upload} if ok else upload)
+            for target, (ok, error, upload) in results.items()}
+
+def preflight_or_discover(ip, port, remote_dir, discover=True):
+    status = VitaFTP(ip, port).preflight(remote_dir)
+    if status['reachable'] or not discover:
+        return status
+    
+    # The DHCP lease may have moved the Vita; look for it on the local subnet
+    for found_ip, banner in discover_vitas(port):
+        if found_ip == ip:
+            continue
+        found_status = VitaFTP(found_ip, port).preflight(remote_dir)
+        if found_status['reachable']:
+            found_status['discovered'] = True
+            return found_status
+    return status
+
+def start_preflight(ip, port, remote_dir, discover=True):
+    # Runs the preflight (and discovery fallback) in the background and returns a Future
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(preflight_or_discover, ip, port, remote_dir, discover)
+    executor.shutdown(wait=False)
+    return future
\ No newline at end of file
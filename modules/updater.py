@@ -1,26 +1,93 @@
-import requests
-from packaging import version
+import os
+import json
+import time
+import threading
 
 try:
     from .VERSION import VERSION
+    from .constants import PSVMP_DIR
 except ImportError:
     from VERSION import VERSION
+    from constants import PSVMP_DIR
 
 PACKAGE_NAME = "psvmp"
 PYPI_URL = f"https://pypi.org/pypi/{PACKAGE_NAME}/json"
 
-def check_for_update():
-    current = str(VERSION)
+UPDATE_CACHE_FILE = os.path.join(PSVMP_DIR, "update_check.json")
+UPDATE_CACHE_TTL = 24 * 60 * 60  # seconds
+
+_refresh_thread = None
+_refresh_lock = threading.Lock()
+
+def _is_newer(latest):
+    from packaging import version
+    return version.parse(str(VERSION)) < version.parse(latest)
+
+def _read_cache():
     try:
-        resp = requests.get(PYPI_URL, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        latest = data["info"]["version"]
+        with open(UPDATE_CACHE_FILE, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        return cache if 'latest' in cache and 'checked' in cache else None
+    except (OSError, ValueError):
+        return None
+
+def _write_cache(latest):
+    os.makedirs(PSVMP_DIR, exist_ok=True)
+    tmp_path = UPDATE_CACHE_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'latest': latest, 'checked': time.time()}, f)
+    os.replace(tmp_path, UPDATE_CACHE_FILE)
 
-        if version.parse(current) < version.parse(latest):
-            return True, latest  # Update available
-        return False, latest  # Up to date
+def fetch_latest_version(timeout=10):
+    try:
+        import requests
+        resp = requests.get(PYPI_URL, timeout=timeout)
+        resp.raise_for_status()
+        latest = resp.json()["info"]["version"]
+        _write_cache(latest)
+        return _is_newer(latest), latest
+    except ImportError as e:
+        return None, str(e)
     except requests.exceptions.RequestException as e:
         return None, f"Network error: {e}"
     except Exception as e:
-        return None, str(e)
\ No newline at end of file
+        return None, str(e)
+
+def start_background_refresh(timeout=10):
+    # Refreshes the cache in a daemon thread if it is stale; never blocks
+    global _refresh_thread
+    
+    cache = _read_cache()
+    if cache and time.time() - cache['checked'] < UPDATE_CACHE_TTL:
+        return None
+    
+    with _refresh_lock:
+        if _refresh_thread is None or not _refresh_thread.is_alive():
+            _refresh_thread = threading.Thread(target=fetch_latest_version, args=(timeout,),
+                                               name='update-check', daemon=True)
+            _refresh_thread.start()
+        return _refresh_thread
+
+def check_for_update(offline=False, wait=False, timeout=10):
+    # Returns (True, latest) if an update is available, (False, latest) if up
+    # to date and (None, reason) if unknown. Answers from the on-disk cache
+    # first; wait=True blocks (up to timeout) for a fresh result when the
+    # cache is stale, falling back to the stale answer if PyPI can't be reached.
+    cache = _read_cache()
+    fresh = cache is not None and time.time() - cache['checked'] < UPDATE_CACHE_TTL
+    
+    if fresh or (cache and offline):
+        return _is_newer(cache['latest']), cache['latest']
+    if offline:
+        return None, "No cached update information (offline mode)"
+    
+    if wait:
+        result = fetch_latest_version(timeout)
+        if result[0] is None and cache:
+            return _is_newer(cache['latest']), cache['latest']
+        return result
+    
+    start_background_refresh(timeout)
+    if cache:
+        return _is_newer(cache['latest']), cache['latest']
+    return None, "Update check running in the background, try again shortly"
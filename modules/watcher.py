@@ -0,0 +1,140 @@
+import os
+import sys
+import time
+import select
+import ctypes
+import ctypes.util
+from .helpers import logger
+from .pipeline import media_type_for_file
+from .cache import file_fingerprint
+from .history import completed_targets
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+class _Inotify:
+    # Minimal inotify binding; only used to wake the watch loop early
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        return bool(ready)
+
+    def close(self):
+        os.close(self.fd)
+
+class FolderWatcher:
+    def __init__(self, folder, targets, workers=2, stable_seconds=5, poll_interval=2):
+        self.folder = os.path.abspath(folder)
+        self.targets = targets
+        self.workers = workers
+        self.stable_seconds = stable_seconds
+        self.poll_interval = poll_interval
+        self.candidates = {}  # path -> (size, mtime, unchanged_since)
+        self.seen = {}        # path -> (size, mtime) already handed to a worker
+        self.inotify = None
+        
+        if sys.platform.startswith('linux'):
+            try:
+                self.inotify = _Inotify(self.folder)
+            except (OSError, AttributeError) as e:
+                logger.warning(f"inotify unavailable, falling back to polling: {e}")
+
+    def scan(self):
+        # Returns files whose size and mtime have not changed for stable_seconds
+        now = time.monotonic()
+        stable = []
+        present = set()
+        
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or entry.name.startswith('.') or not media_type_for_file(entry.name):
+                continue
+            present.add(entry.path)
+            stat = entry.stat()
+            signature = (stat.st_size, stat.st_mtime)
+            
+            if self.seen.get(entry.path) == signature:
+                continue
+            
+            previous = self.candidates.get(entry.path)
+            if previous is None or previous[:2] != signature:
+                self.candidates[entry.path] = (*signature, now)
+            elif now - previous[2] >= self.stable_seconds and stat.st_size > 0:
+                del self.candidates[entry.path]
+                self.seen[entry.path] = signature
+                stable.append(entry.path)
+        
+        for path in list(self.candidates):
+            if path not in present:
+                del self.candidates[path]
+        return stable
+
+    def wait(self):
+        # Wake early on inotify events, but keep ticking while files settle
+        timeout = self.poll_interval if not self.candidates else min(self.poll_interval, 1)
+        if self.inotify:
+            self.inotify.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+    def run(self):
+        # Files become jobs on the same stage pools as playlists, so storage
+        # admission, bandwidth limits and priority lanes apply to them too
+        from .api import Pipeline
+        
+        mode = "inotify" if self.inotify else "polling"
+        logger.info(f"Watching {self.folder} ({mode}, {self.workers} workers)")
+        print(f"Watching {self.folder} ({mode}, {self.workers} workers). Press Ctrl+C to stop.")
+        
+        pipeline = Pipeline(self.targets, download_workers=self.workers, convert_workers=self.workers,
+                            transfer_workers=self.workers)
+        try:
+            while True:
+                for path in self.scan():
+                    print(f"New file: {os.path.basename(path)}")
+                    self._submit(pipeline, path)
+                self.wait()
+        except KeyboardInterrupt:
+            print("\nStopping watcher, waiting for running jobs to finish...")
+        finally:
+            pipeline.close()
+            if self.inotify:
+                self.inotify.close()
+
+    def _submit(self, pipeline, path):
+        name = os.path.basename(path)
+        try:
+            done = completed_targets(file_fingerprint(path))
+        except OSError as e:
+            logger.error(f"Watch job failed for {path}: {e}")
+            print(f"Failed: {name}: {e}")
+            return
+        pending = [(ip, port) for ip, port in self.targets if f"{ip}:{port}" not in done]
+        if not pending:
+            logger.info(f"Already transferred, skipping: {name}")
+            print(f"Already transferred, skipping: {name}")
+            return
+        
+        def report(job):
+            if job.state == 'completed':
+                print(f"Done: {name}")
+            else:
+                print(f"{job.state.capitalize()}: {name}" + (f" ({job.error})" if job.error else ""))
+        
+        job = pipeline.submit(path, media_type_for_file(path), targets=pending)
+        job.add_done_callback(report)
@@ -3,9 +3,6 @@
 
 import sys, io
 
-sys.stdout = io.TextIOWrapper(sys.stdout.detach(), encoding="utf-8", errors="replace")
-sys.stderr = io.TextIOWrapper(sys.stderr.detach(), encoding="utf-8", errors="replace")
-
 logo = """
  ######   #####  #     # #     # ######  
  #     # #     # #     # ##   ## #     # 
@@ -19,10 +16,9 @@ logo = """
 # Change this import
 from modules.VERSION import VERSION
 
-import time
 import os
-import sys
 import argparse
+import shutil
 import logging
 from datetime import datetime
 
@@ -31,131 +27,258 @@ from datetime import datetime
 from modules.constants import (
     DEFAULT_VITA_IP, DEFAULT_VITA_PORT, 
     VITA_VIDEO_PATH, VITA_MUSIC_PATH,
-    TEMP_FOLDER, CONVERTED_FOLDER
+    TEMP_FOLDER
 )
 from modules.config import (
     load_config, save_config, show_config, 
-    update_config_from_args, handle_config_command
+    update_config_from_args, handle_config_command, remember_vita_ip,
+    resolve_vita_targets
 )
-from modules.download import download_media
-from modules.conversion import convert_for_vita_video, convert_for_vita_music
-from modules.transfer import VitaFTP
 from modules.helpers import (
     setup_logging, logger, check_dependencies,
-    sanitize_filename, cleanup_temp_files
+    parse_size
 )
 
 from modules.history import log_to_history, show_history, clear_history
 
-from modules.updater import check_for_update
+# Stage modules (and requests/tqdm behind them) are imported where they are
+# used, so --history, --config and --version start quickly.
 
-def process_media(url, vita_ip, vita_port, media_type='video'):
-    try:
-        # Check dependencies first
-        if not check_dependencies():
-            log_to_history(url, media_type, "failed", "Missing dependencies")
-            return False
-        
-        # 1. Download media
-        logger.info(f"Starting media processing: {media_type} from {url}")
-        print("=" * 50)
-        print("STEP 1: DOWNLOADING MEDIA")
-        print("=" * 50)
-        downloaded_file = download_media(url, media_type)
-        logger.info("Download completed successfully!")
-        print("Download completed successfully!")
-        
-        # 2. Convert media
+def process_media(url, targets, media_type='video', offline_action='hold', auto_discover=True,
+                  video_encoder='libx264', target_size=None, two_pass=False):
+    # One job through the same Pipeline as playlists and --serve; the CLI
+    # only adds the step banners and the questions at the end
+    from modules.api import Pipeline
+    
+    if not check_dependencies((media_type,), video_encoder):
+        log_to_history(url, media_type, "failed", "Missing dependencies")
+        return False
+    
+    steps = {'download': "STEP 1: DOWNLOADING MEDIA",
+             'convert': "STEP 2: CONVERTING FOR PS VITA",
+             'transfer': "STEP 3: TRANSFERRING TO PS VITA"}
+    
+    def report(job, fields):
+        if fields.get('state') == 'running':
+            print("\n" + "=" * 50)
+            print(steps[job.stage])
+            print("=" * 50)
+        elif fields.get('progress'):
+            print(f"  {job.progress}", flush=True)
+    
+    logger.info(f"Starting media processing: {media_type} from {url}")
+    with Pipeline(targets, download_workers=1, convert_workers=1, transfer_workers=1,
+                  discover=auto_discover, offline_action=offline_action) as pipeline:
+        job = pipeline.submit(url, media_type, target_size=target_size, two_pass=two_pass, on_update=report)
+        job.wait()
+    
+    converted_file = job.converted_file
+    if job.state == 'completed':
+        logger.info(f"Media processing completed successfully: {os.path.basename(converted_file)}")
         print("\n" + "=" * 50)
-        print("STEP 2: CONVERTING FOR PS VITA")
+        print(f"SUCCESS! {media_type.upper()} TRANSFERRED TO {len(job.uploads)} PS VITA(S)")
         print("=" * 50)
         
-        if media_type == 'music':
-            output_extension = ".mp3"
-            vita_path = VITA_MUSIC_PATH
-            conversion_func = convert_for_vita_music
+        keep_converted = input("Keep converted file for backup? (y/n): ").strip().lower()
+        if keep_converted != 'y':
+            os.remove(converted_file)
+            logger.info(f"Deleted converted file: {os.path.basename(converted_file)}")
+            print(f"Deleted converted file: {os.path.basename(converted_file)}")
         else:
-            output_extension = "_psvita.mp4"
-            vita_path = VITA_VIDEO_PATH
-            conversion_func = convert_for_vita_video
-        
-        base_name = sanitize_filename(os.path.splitext(os.path.basename(downloaded_file))[0])
-        output_filename = base_name + output_extension
-        output_path = os.path.join(CONVERTED_FOLDER, output_filename)
-        
-        converted_file = conversion_func(downloaded_file, output_path)
-        
-        # 3. Transfer to Vita
-        print("\n" + "=" * 50)
-        print("STEP 3: TRANSFERRING TO PS VITA")
-        print("=" * 50)
-        print(f"Target: {vita_path}")
+            logger.info(f"Converted file kept at: {converted_file}")
+            print(f"Converted file kept at: {converted_file}")
+        return True
+    
+    if job.state == 'held' and converted_file:
+        hold_for_later(converted_file, job.error)
         print("Make sure VitaShell FTP is running (Press SELECT in VitaShell)")
-        print("Waiting 3 seconds for you to confirm...")
-        time.sleep(3)
-        
-        ftp = VitaFTP(vita_ip, vita_port)
-        remote_path = f"{vita_path}{os.path.basename(converted_file)}"
-        
-        def progress_callback(message):
-            print(f"  {message}" , flush=True)
-        
-        if ftp.transfer(converted_file, remote_path, progress_callback):
-            logger.info(f"Media processing completed successfully: {os.path.basename(converted_file)}")
-            print("\n" + "=" * 50)
-            print(f"SUCCESS! {media_type.upper()} TRANSFERRED TO PS VITA")
-            print("=" * 50)
-            
-            log_to_history(url, media_type, "completed")
-            
-            # Clean up
-            print("\nCleaning up temporary files...")
-            os.remove(downloaded_file)
-            logger.info(f"Deleted temporary download: {os.path.basename(downloaded_file)}")
-            print(f"Deleted temporary download: {os.path.basename(downloaded_file)}")
-            
-            keep_converted = input("Keep converted file for backup? (y/n): ").strip().lower()
-            if keep_converted != 'y':
+        return False
+    
+    print(f"\nERROR: {job.error or job.state}", file=sys.stderr)
+    if converted_file and os.path.exists(converted_file):
+        if job.uploads:
+            # Some devices still need this file
+            print(f"Converted file kept for the remaining devices at: {converted_file}")
+            return False
+        cleanup = input("Clean up the converted file? (y/n): ").strip().lower()
+        if cleanup == 'y':
+            try:
                 os.remove(converted_file)
-                logger.info(f"Deleted converted file: {os.path.basename(converted_file)}")
-                print(f"Deleted converted file: {os.path.basename(converted_file)}")
-            else:
-                logger.info(f"Converted file kept at: {converted_file}")
-                print(f"Converted file kept at: {converted_file}")
-            
-            return True
-        
+                logger.info(f"Cleaned up on error: {os.path.basename(converted_file)}")
+                print(f"Deleted: {os.path.basename(converted_file)}")
+            except Exception as cleanup_error:
+                logger.warning(f"Failed to clean up {converted_file}: {cleanup_error}")
+    return False
+
+def process_playlist(url, targets, media_type='video', workers=3, auto_discover=True,
+                     video_encoder='libx264', target_size=None, two_pass=False):
+    from modules.download import expand_playlist, is_mega_folder_url, download_mega_folder
+    from modules.transfer import preflight_or_discover
+    from modules.pipeline import get_output_settings, list_media_folder
+    from modules.api import Pipeline
+    
+    if not check_dependencies((media_type,), video_encoder):
+        log_to_history(url, media_type, "failed", "Missing dependencies")
+        return False
+    
+    try:
+        if os.path.isdir(url):
+            title, entries = os.path.basename(os.path.abspath(url)), list_media_folder(url, media_type)
+        else:
+            title, entries = expand_playlist(url)
     except Exception as e:
-        logger.error(f"Media processing failed: {str(e)}")
-        print(f"\nERROR: {str(e)}", file=sys.stderr)
-        
+        if not is_mega_folder_url(url):
+            logger.error(f"Could not expand playlist {url}: {e}")
+            print(f"\nERROR: {e}", file=sys.stderr)
+            log_to_history(url, media_type, "failed", str(e))
+            return False
+        # Fall back to one megatools run for the whole folder; files are
+        # queued as local jobs while the rest of the folder downloads
+        logger.warning(f"Could not list Mega folder {url} ({e}), downloading it as a whole")
+        title, entries = "Mega folder", None
+    
+    if entries == []:
+        print("The playlist is empty, nothing to do.")
+        return False
+    
+    # MP3 encoding uses one core per track, so music batches encode one
+    # track per core; video encoders already use every core themselves
+    convert_workers = (os.cpu_count() or 1) if media_type == 'music' else 1
+    if os.path.isdir(url):
+        # Local files skip the download stage, so feed the encoders directly
+        workers = max(workers, convert_workers)
+    
+    if entries is None:
+        print(f"Playlist: {title} (listing unavailable, items start as they finish downloading)")
+    else:
+        print(f"Playlist: {title} ({len(entries)} items, {workers} at a time)")
+    
+    # Check (and if needed find) the Vitas once for the whole playlist,
+    # rather than once per item
+    _, vita_path, _ = get_output_settings(media_type)
+    discover = auto_discover and len(targets) == 1
+    statuses = [preflight_or_discover(ip, port, vita_path, discover) for ip, port in targets]
+    for (vita_ip, _), status in zip(targets, statuses):
+        if status.get('discovered'):
+            print(f"PS Vita not found at {vita_ip}, discovered it at {status['ip']}")
+            remember_vita_ip(status['ip'])
+        elif not status['reachable']:
+            print(f"Warning: PS Vita not reachable at {status['ip']}:{status['port']} ({status['error']})")
+    targets = [(status['ip'], status['port']) for status in statuses]
+    
+    if target_size == 'card':
+        # Share what is left on the memory card evenly between the items
+        free_space = [status['free_bytes'] for status in statuses
+                      if status['reachable'] and status['free_bytes'] is not None]
+        target_size = int(min(free_space) * 0.95) // len(entries) if free_space and entries else None
+        if target_size is None:
+            print("Warning: Free space on the PS Vita or item count is unknown, converting at the default bitrate")
+    
+    def report(job, fields, position, name):
+        total = len(entries) if entries is not None else '?'
+        if fields.get('state') == 'running':
+            print(f"[{position}/{total}] {job.stage}: {name}", flush=True)
+        elif 'error' in fields:
+            suffix = f" ({job.error})" if job.error else ""
+            print(f"[{position}/{total}] {job.state}: {name}{suffix}", flush=True)
+    
+    pipeline = Pipeline(targets, download_workers=workers, convert_workers=convert_workers,
+                        transfer_workers=1, discover=False)
+    jobs = []
+    
+    def submit(item_url, name):
+        position = len(jobs) + 1
+        jobs.append(pipeline.submit(item_url, media_type, target_size=target_size, two_pass=two_pass,
+                                    on_update=lambda job, fields: report(job, fields, position, name)))
+    
+    folder = None
+    try:
+        if entries is None:
+            folder = os.path.join(TEMP_FOLDER, f"mega-{os.getpid()}")
+            download_mega_folder(url, folder, lambda path: submit(path, os.path.basename(path)))
+        else:
+            for entry in entries:
+                submit(entry['url'], entry['title'])
+        for job in jobs:
+            job.done.wait()
+    except KeyboardInterrupt:
+        print("\nCancelling remaining playlist items...")
+        for job in jobs:
+            job.cancel()
+        return False
+    except Exception as e:
+        # The folder download failed part way; let the queued items finish
+        logger.error(f"Playlist {url} failed: {e}")
+        print(f"\nERROR: {e}", file=sys.stderr)
         log_to_history(url, media_type, "failed", str(e))
-        
-        # Clean up on error
-        cleanup_temp_files(TEMP_FOLDER)
-        temp_files = []
-        if 'downloaded_file' in locals() and os.path.exists(downloaded_file):
-            temp_files.append(downloaded_file)
-        if 'converted_file' in locals() and os.path.exists(converted_file):
-            temp_files.append(converted_file)
-        
-        if temp_files:
-            cleanup = input("Clean up temporary files? (y/n): ").strip().lower()
-            if cleanup == 'y':
-                for file in temp_files:
-                    try:
-                        os.remove(file)
-                        logger.info(f"Cleaned up on error: {os.path.basename(file)}")
-                        print(f"Deleted: {os.path.basename(file)}")
-                    except Exception as cleanup_error:
-                        logger.warning(f"Failed to clean up {file}: {cleanup_error}")
-        
+        for job in jobs:
+            job.done.wait()
         return False
+    finally:
+        pipeline.close()
+        if folder:
+            shutil.rmtree(folder, ignore_errors=True)
+    
+    counts = {}
+    for job in jobs:
+        counts[job.state] = counts.get(job.state, 0) + 1
+    logger.info(f"Playlist {url} finished: {counts}")
+    print("\n" + "=" * 50)
+    print("PLAYLIST FINISHED: " + ", ".join(f"{count} {state}" for state, count in sorted(counts.items())))
+    print("=" * 50)
+    return counts.get('completed', 0) == len(jobs)
+
+def hold_for_later(converted_file, reason):
+    logger.warning(f"Holding converted file for later transfer: {converted_file} ({reason})")
+    print("\n" + "=" * 50)
+    print("PS VITA UNAVAILABLE - CONVERTED FILE HELD")
+    print("=" * 50)
+    print(f"Converted file kept at: {converted_file}")
 
-def check_and_display_update_info():
+def show_toolchain(video_encoder):
+    from modules.toolchain import get_toolchain, pick_video_encoder
+    
+    # Explicit check: always re-probe instead of trusting the cache
+    ok = check_dependencies(video_encoder=video_encoder, refresh=True)
+    toolchain = get_toolchain()
+    
+    print("\nTools:")
+    for tool, info in toolchain['tools'].items():
+        print(f"  {tool}: {info['version']} ({info['path']})")
+    print(f"Encoders: {', '.join(toolchain['encoders']) or 'none'}")
+    broken = [e for e in toolchain['encoders'] if e not in toolchain['working_encoders']]
+    if broken:
+        print(f"Listed but not working (no GPU or driver?): {', '.join(broken)}")
+    print(f"Muxers: {', '.join(toolchain['muxers']) or 'none'}")
+    print(f"Video encoder: {pick_video_encoder(video_encoder)}")
+    
+    if ok:
+        print("\nAll required dependencies are installed!")
+    return ok
+
+def discover_and_display(port):
+    from modules.discovery import discover_vitas
+    
+    print(f"Scanning local network for VitaShell FTP servers on port {port}...")
+    found = discover_vitas(port)
+    
+    if not found:
+        print("No PS Vita found. Make sure VitaShell FTP is running (Press SELECT in VitaShell)")
+        return False
+    
+    for ip, banner in found:
+        print(f"  {ip}:{port}  {banner}")
+    
+    remember_vita_ip(found[0][0])
+    print(f"\nSaved {found[0][0]} as the default PS Vita address")
+    return True
+
+def check_and_display_update_info(wait=False, offline=False, timeout=10):
+    from modules.updater import check_for_update
+    
     print(f"PS Vita Media Processor Version {VERSION}")
     
-    update_result = check_for_update()
+    update_result = check_for_update(offline=offline, wait=wait, timeout=timeout)
     
     if update_result[0] is True:
         # Update available
@@ -170,17 +293,32 @@ def check_and_display_update_info():
         print(f"Could not check for updates: {update_result[1]}")
 
 def main():
+    # Console output may contain any title; never fail on the terminal's encoding
+    sys.stdout = io.TextIOWrapper(sys.stdout.detach(), encoding="utf-8", errors="replace")
+    sys.stderr = io.TextIOWrapper(sys.stderr.detach(), encoding="utf-8", errors="replace")
+    
     parser = argparse.ArgumentParser(description='PS Vita Media Processor')
-    parser.add_argument('url', nargs='?', help='URL of the media file (Mega.nz, YouTube, SoundCloud, etc.)')
+    parser.add_argument('url', nargs='?', help='URL of the media file (Mega.nz, YouTube, SoundCloud, etc.), playlist, or local folder of media files')
     parser.add_argument('--type', choices=['video', 'music'], default='video', help='Type of media to process (default: video)')
-    parser.add_argument('--ip', default=DEFAULT_VITA_IP,  help=f'PS Vita IP address (default: {DEFAULT_VITA_IP})')
-    parser.add_argument('--port', type=int, default=DEFAULT_VITA_PORT,  help=f'PS Vita FTP port (default: {DEFAULT_VITA_PORT})')
+    parser.add_argument('--ip', help=f'PS Vita IP address, comma-separated list (IP or IP:PORT) or device group name (default: vita_ip from config, {DEFAULT_VITA_IP})')
+    parser.add_argument('--port', type=int, help=f'PS Vita FTP port (default: vita_port from config, {DEFAULT_VITA_PORT})')
+    parser.add_argument('--target-size', metavar='SIZE', help="Encode video to fit SIZE (e.g. 700M, 1.5G), or 'card' for the free space on the PS Vita")
+    parser.add_argument('--two-pass', action='store_true', help='Use two-pass encoding for a more accurate --target-size')
     parser.add_argument('--check-deps', action='store_true', help='Check if required dependencies are installed')
+    parser.add_argument('--watch', metavar='DIR', help='Watch a folder and convert and transfer video/audio files dropped into it')
+    parser.add_argument('--serve', action='store_true', help='Run a local HTTP job service (submit, list, cancel jobs)')
+    parser.add_argument('--listen', default='127.0.0.1:8765', metavar='HOST:PORT', help='Address for --serve (default: 127.0.0.1:8765)')
+    parser.add_argument('--workers', type=int, help='Number of parallel jobs in --watch mode, parallel downloads in --serve mode (default: 2), or parallel playlist items (default: playlist_workers from config)')
+    parser.add_argument('--discover', action='store_true', help='Scan the local network for VitaShell FTP servers and save the first one found')
     parser.add_argument('-v', '--version', action='store_true', help='Show version information and exit')
     parser.add_argument('-u', '--update', action='store_true', help='Check for updates and exit')
+    parser.add_argument('--offline', action='store_true', help='Never contact PyPI; update information comes from the local cache only')
     parser.add_argument('--history', action='store_true', help='Show download history')
     parser.add_argument('--history-clear', action='store_true', help='Clear download history')
     parser.add_argument('--history-limit', type=int, default=10, help='Number of history entries to show (default: 10)')
+    parser.add_argument('--trace', metavar='FILE', help='Record every stage of every job (downloads, probes, encodes, uploads, queue waits) as a Chrome trace-event JSON file')
+    parser.add_argument('--metrics', metavar='HOST:PORT', help='Serve Prometheus metrics on http://HOST:PORT/metrics while running (--serve always has them at /metrics)')
+    parser.add_argument('--profile', action='store_true', help='Run under cProfile and save the stats to the logs folder')
     
     config_group = parser.add_argument_group('configuration options')
     config_group.add_argument('--config', '-c', action='store_true', help='Show configuration file location and current settings')
@@ -188,9 +326,22 @@ def main():
     config_group.add_argument('--config-show', dest='show_config', action='store_true', help='Show current configuration')
     
     args = parser.parse_args()
+    setup_logging()
+    
+    if args.trace or args.profile:
+        from modules.tracing import instrument
+        with instrument(args.trace, args.profile):
+            run(parser, args)
+    else:
+        run(parser, args)
+
+def run(parser, args):
+    config = load_config(silent=True)
+    offline = args.offline or config['offline']
     
     if args.update:
-        check_and_display_update_info()
+        # Explicit request: wait for a fresh answer unless the cache is recent
+        check_and_display_update_info(wait=True, offline=offline)
         sys.exit(0)
     
     if args.config or args.set_config or args.show_config:
@@ -199,7 +350,10 @@ def main():
         else:
             sys.exit(1)
     
-    load_config(silent=True)
+    if args.ip is None:
+        args.ip = config['vita_ip']
+    if args.port is None:
+        args.port = config['vita_port']
     
     if args.history:
         show_history(args.history_limit)
@@ -213,27 +367,75 @@ def main():
         sys.exit(0)
     
     if args.check_deps:
-        if check_dependencies():
-            print("All required dependencies are installed!")
+        show_toolchain(config['video_encoder'])
         sys.exit(0)
     
+    if args.discover:
+        sys.exit(0 if discover_and_display(args.port) else 1)
+    
     if args.version:
-        check_and_display_update_info()
+        # Exits right away, so a background refresh would never finish;
+        # fetch in the foreground, but only briefly
+        check_and_display_update_info(wait=True, offline=offline, timeout=3)
+        sys.exit(0)
+    
+    if not offline:
+        # Refresh the update cache while the job runs; never waits on PyPI
+        from modules.updater import start_background_refresh
+        start_background_refresh()
+    
+    if args.metrics:
+        from modules.metrics import serve_metrics
+        host, _, metrics_port = args.metrics.rpartition(':')
+        serve_metrics(host or '127.0.0.1', int(metrics_port))
+    
+    if args.watch:
+        if not os.path.isdir(args.watch):
+            parser.error(f"Watch folder does not exist: {args.watch}")
+        if not check_dependencies(video_encoder=config['video_encoder']):
+            sys.exit(1)
+        from modules.watcher import FolderWatcher
+        FolderWatcher(args.watch, resolve_vita_targets(args.ip, args.port, config), args.workers or 2).run()
+        sys.exit(0)
+    
+    if args.serve:
+        if not check_dependencies(video_encoder=config['video_encoder']):
+            sys.exit(1)
+        from modules.server import JobService, serve
+        host, _, listen_port = args.listen.rpartition(':')
+        service = JobService(
+            resolve_vita_targets(args.ip, args.port, config),
+            lambda ip: resolve_vita_targets(ip, args.port, config),
+            download_workers=args.workers or 2
+        )
+        serve(service, host or '127.0.0.1', int(listen_port))
         sys.exit(0)
 
     if not args.url:
-        parser.error("URL is required unless using --check-deps or --config")
+        parser.error("URL is required unless using --watch, --serve, --check-deps, --discover or --config")
     
-    config, config_changed = update_config_from_args(args)
+    overrides, config_changed = update_config_from_args(args)
     if config_changed:
         logger.info("Using command-line overrides for this session")
     
+    logger.info("=" * 50)
+    logger.info("PS Vita Media Processor started")
+    logger.info("=" * 50)
+    
     print(logo)
     print(f"    PS Vita Media Processor")
     print(f"        Version {VERSION}")
     print("-" * 50)
     print(f"Media Type: {args.type.upper()}")
-    print(f"Vita IP: {args.ip}:{args.port}")
+    target_size = args.target_size
+    if target_size and target_size != 'card':
+        try:
+            target_size = parse_size(target_size)
+        except ValueError as e:
+            parser.error(str(e))
+    
+    targets = resolve_vita_targets(args.ip, args.port, config)
+    print(f"Vita IP: {', '.join(f'{ip}:{port}' for ip, port in targets)}")
     print(f"URL: {args.url}")
     if args.type == 'video':
         print(f"Destination: {VITA_VIDEO_PATH}")
@@ -241,7 +443,18 @@ def main():
         print(f"Destination: {VITA_MUSIC_PATH}")
     print("-" * 50)
     
-    if not process_media(args.url, args.ip, args.port, args.type):
+    from modules.download import is_playlist_url
+    if os.path.isdir(args.url) or is_playlist_url(args.url):
+        workers = args.workers or config['playlist_workers']
+        if not process_playlist(args.url, targets, args.type, workers,
+                                config['auto_discover'], config['video_encoder'],
+                                target_size, args.two_pass):
+            sys.exit(1)
+        sys.exit(0)
+    
+    if not process_media(args.url, targets, args.type,
+                         config['offline_action'], config['auto_discover'], config['video_encoder'],
+                         target_size, args.two_pass):
         sys.exit(1)
 
 if __name__ == "__main__":